@@ -1,6 +1,7 @@
 import json
 import sys
-from typing import Any, Dict, List
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 
 def read_input() -> Dict[str, Any]:
@@ -21,3 +22,104 @@ def node_lans(node: Dict[str, str], node_id: str) -> List[str]:
     base = f"/nodes/{node_id}/lan"
     raw = node.get(base, "")
     return sorted(set(split_ml(raw)))
+
+
+class NodeView:
+    """One node's keys from the flat /nodes/ map, with lazily parsed sections.
+
+    ``values`` maps the key tail (after ``/nodes/<node_id>/``) to its value.
+    """
+
+    __slots__ = ("node_id", "values", "_instances", "_lans", "_private_lans")
+
+    def __init__(self, node_id: str) -> None:
+        self.node_id = node_id
+        self.values: Dict[str, str] = {}
+        self._instances: Dict[str, Dict[str, Dict[str, str]]] = {}
+        self._lans: Optional[List[str]] = None
+        self._private_lans: Optional[List[str]] = None
+
+    def get(self, tail: str, default: str = "") -> str:
+        return self.values.get(tail, default)
+
+    def flat(self) -> Dict[str, str]:
+        """The node's keys in full /nodes/<node_id>/... form."""
+        base = f"/nodes/{self.node_id}/"
+        return {base + k: v for k, v in self.values.items()}
+
+    def subtree(self, section: str) -> Dict[str, str]:
+        """Keys under ``<section>/``, e.g. subtree("tinc") -> {"ipv4": ...}."""
+        base = section + "/"
+        return {k[len(base):]: v for k, v in self.values.items() if k.startswith(base)}
+
+    def instances(self, section: str) -> Dict[str, Dict[str, str]]:
+        """Named instances under ``<section>/<name>/...`` (openvpn, wireguard)."""
+        out = self._instances.get(section)
+        if out is None:
+            out = {}
+            for k, v in self.subtree(section).items():
+                parts = k.split("/", 1)
+                if len(parts) != 2:
+                    continue
+                out.setdefault(parts[0], {})[parts[1]] = v
+            self._instances[section] = out
+        return out
+
+    @property
+    def lans(self) -> List[str]:
+        if self._lans is None:
+            self._lans = sorted(set(split_ml(self.values.get("lan", ""))))
+        return self._lans
+
+    @property
+    def private_lans(self) -> List[str]:
+        if self._private_lans is None:
+            self._private_lans = split_ml(self.values.get("private_lan", ""))
+        return self._private_lans
+
+
+class Fleet:
+    """Per-node views of a flat /nodes/ map, built in one pass."""
+
+    __slots__ = ("nodes",)
+
+    def __init__(self, all_nodes: Dict[str, str]) -> None:
+        self.nodes: Dict[str, NodeView] = {}
+        base = "/nodes/"
+        for k, v in all_nodes.items():
+            if not k.startswith(base):
+                continue
+            parts = k[len(base):].split("/", 1)
+            if len(parts) != 2:
+                continue
+            nid, tail = parts
+            view = self.nodes.get(nid)
+            if view is None:
+                view = self.nodes[nid] = NodeView(nid)
+            view.values[tail] = v
+
+    def __iter__(self) -> Iterator[NodeView]:
+        return iter(self.nodes.values())
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+_fleet_lock = threading.Lock()
+_fleet_last: Optional[Tuple[Dict[str, str], Fleet]] = None
+
+
+def fleet_index(all_nodes: Dict[str, str]) -> Fleet:
+    """Return the Fleet for ``all_nodes``, reusing the last one for the same snapshot.
+
+    In-process callers pass the same snapshot dict to every generator of a
+    reconcile, so the fleet is indexed once per snapshot.
+    """
+    global _fleet_last
+    with _fleet_lock:
+        last = _fleet_last
+        if last is not None and last[0] is all_nodes:
+            return last[1]
+        fleet = Fleet(all_nodes)
+        _fleet_last = (all_nodes, fleet)
+        return fleet
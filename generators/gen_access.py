@@ -2,7 +2,7 @@ import ipaddress
 import json
 from typing import Any, Dict, List, Optional, Tuple
 
-from common import read_input, write_output, split_ml, node_lans
+from common import Fleet, fleet_index, read_input, write_output, split_ml
 
 
 def _is_inline(text: str) -> bool:
@@ -61,31 +61,17 @@ def _collect_push_routes(
         seen.add(key)
         routes.append(key)
 
-    base = "/nodes/"
-    per_node: Dict[str, Dict[str, str]] = {}
-    for k, v in all_nodes.items():
-        if not k.startswith(base):
-            continue
-        rest = k[len(base):]
-        parts = rest.split("/", 1)
-        if len(parts) != 2:
-            continue
-        nid, tail = parts
-        per_node.setdefault(nid, {})
-        per_node[nid][f"/nodes/{nid}/{tail}"] = v
-
-    if not per_node:
-        per_node[node_id] = node
-
-    for nid, data in per_node.items():
-        for pfx in node_lans(data, nid):
+    fleet = fleet_index(all_nodes)
+    if not len(fleet):
+        fleet = Fleet(node)
+
+    for view in fleet:
+        for pfx in view.lans:
+            add_network(pfx)
+        for pfx in view.private_lans:
             add_network(pfx)
-        for pfx in split_ml(data.get(f"/nodes/{nid}/private_lan", "")):
+        for pfx in view.subtree("network_mapping"):
             add_network(pfx)
-        mapping_base = f"/nodes/{nid}/network_mapping/"
-        for key in data:
-            if key.startswith(mapping_base):
-                add_network(key[len(mapping_base):])
 
     for pfx in split_ml(global_cfg.get("/global/bgp/edge_broadcast", "")):
         add_network(pfx)
@@ -251,13 +237,16 @@ def generate_access(node_id: str, node: Dict[str, str], global_cfg: Dict[str, st
     }
 
 
-def main() -> None:
-    payload = read_input()
+def generate(payload: Dict[str, Any]) -> Dict[str, Any]:
     node_id = payload["node_id"]
     node = payload["node"]
     global_cfg = payload.get("global", {})
     all_nodes = payload.get("all_nodes", {})
-    write_output(generate_access(node_id, node, global_cfg, all_nodes))
+    return generate_access(node_id, node, global_cfg, all_nodes)
+
+
+def main() -> None:
+    write_output(generate(read_input()))
 
 
 if __name__ == "__main__":
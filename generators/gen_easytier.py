@@ -74,13 +74,15 @@ def generate_config(node_id: str, node: Dict[str, str], global_cfg: Dict[str, st
     }
 
 
-def main() -> None:
-    payload = read_input()
+def generate(payload: Dict[str, Any]) -> Dict[str, Any]:
     node_id = payload["node_id"]
     node = payload["node"]
     global_cfg = payload["global"]
-    out = generate_config(node_id, node, global_cfg)
-    write_output(out)
+    return generate_config(node_id, node, global_cfg)
+
+
+def main() -> None:
+    write_output(generate(read_input()))
 
 
 if __name__ == "__main__":
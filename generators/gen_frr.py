@@ -1,8 +1,9 @@
 import json
 import ipaddress
-from typing import Any, Dict, List, Tuple, Set
+import zlib
+from typing import Any, Dict, List, Optional, Tuple, Set
 
-from common import read_input, write_output, split_ml, node_lans
+from common import Fleet, fleet_index, read_input, write_output, split_ml, node_lans
 
 TAG_NO_REINJECT = 65000
 
@@ -183,41 +184,48 @@ def _node_is_exit(ovpn: Dict[str, Dict[str, str]], wg: Dict[str, Dict[str, str]]
 
 def _internal_bgp_neighbors(
     node_id: str,
-    all_nodes: Dict[str, str],
+    fleet: Fleet,
 ) -> Dict[str, Dict[str, str]]:
     out: Dict[str, Dict[str, str]] = {}
-    base = "/nodes/"
-    per_node: Dict[str, Dict[str, str]] = {}
-    for k, v in all_nodes.items():
-        if not k.startswith(base):
-            continue
-        rest = k[len(base):]
-        parts = rest.split("/", 1)
-        if len(parts) != 2:
-            continue
-        nid, tail = parts
-        per_node.setdefault(nid, {})
-        per_node[nid][f"/nodes/{nid}/{tail}"] = v
-    for nid, data in per_node.items():
+    for view in fleet:
+        nid = view.node_id
         if nid == node_id:
             continue
-        router_id = data.get(f"/nodes/{nid}/router_id", "")
+        router_id = view.get("router_id")
         if not router_id:
             continue
-        ovpn = _parse_openvpn(nid, data)
-        wg = _parse_wireguard(nid, data)
+        ovpn = view.instances("openvpn")
+        wg = view.instances("wireguard")
         # Get node behavior: "static" (default) or "roaming"
         # Roaming nodes should not be used for transit traffic
-        behavior = data.get(f"/nodes/{nid}/behavior", "static") or "static"
+        behavior = view.get("behavior", "static") or "static"
         out[nid] = {
             "router_id": router_id,
             "is_exit": "true" if _node_is_exit(ovpn, wg) else "false",
             "name": nid,
             "is_roaming": "true" if behavior == "roaming" else "false",
+            "is_rr": "true" if view.get("bgp/route_reflector") == "true" else "false",
         }
     return out
 
 
+def _route_reflector_topology(
+    is_rr: bool,
+    neighbors: Dict[str, Dict[str, str]],
+) -> Tuple[bool, Dict[str, Dict[str, str]]]:
+    """Return (rr_mode, neighbors to configure) for the local node.
+
+    Route-reflector mode is on when any node sets /nodes/<id>/bgp/route_reflector.
+    Reflectors peer with every node (other reflectors as a non-client mesh,
+    the rest as clients); clients peer only with the reflectors.
+    Without reflectors the full iBGP mesh is kept.
+    """
+    rr_mode = is_rr or any(info["is_rr"] == "true" for info in neighbors.values())
+    if not rr_mode or is_rr:
+        return rr_mode, neighbors
+    return rr_mode, {nid: info for nid, info in neighbors.items() if info["is_rr"] == "true"}
+
+
 def _iter_bgp_transports(
     ovpn: Dict[str, Dict[str, str]],
     wg: Dict[str, Dict[str, str]],
@@ -232,6 +240,19 @@ def _iter_bgp_transports(
     return out
 
 
+def _inbound_route_map(peer_ip: str, cfg: Dict[str, str], has_no_forward: bool) -> str:
+    no_transit, no_forward = _get_bgp_control_flags(cfg)
+    if no_transit:
+        # Use peer-specific inbound route-map with AS_PATH filtering
+        return "RM-BGP-IN-" + peer_ip.replace(".", "-")
+    if has_no_forward and not no_forward:
+        # This is a normal eBGP peer - tag routes for no_forward filtering
+        # Use wrapper route-map that tags eBGP routes
+        return "RM-BGP-IN-TAG-EBGP"
+    # Standard inbound filter
+    return "RM-BGP-IN"
+
+
 def _get_bgp_control_flags(cfg: Dict[str, str]) -> Tuple[bool, bool]:
     """
     Get no_transit and no_forward flags from BGP config.
@@ -259,7 +280,267 @@ def _get_bgp_control_flags(cfg: Dict[str, str]) -> Tuple[bool, bool]:
     return no_transit, no_forward
 
 
-def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str], all_nodes: Dict[str, str]) -> Dict[str, Any]:
+# Peer-group for iBGP neighbors accepted through "bgp listen range"
+IBGP_PEER_GROUP = "IBGP"
+IBGP_LISTEN_LIMIT_DEFAULT = "1024"
+
+
+def _ipv4_networks(prefixes: List[str]) -> Tuple[List[ipaddress.IPv4Network], List[str]]:
+    """Split prefixes into parsed IPv4 networks and entries kept verbatim."""
+    nets: List[ipaddress.IPv4Network] = []
+    other: List[str] = []
+    for pfx in prefixes:
+        try:
+            net = ipaddress.ip_network(pfx, strict=False)
+        except ValueError:
+            other.append(pfx)
+            continue
+        if isinstance(net, ipaddress.IPv4Network):
+            nets.append(net)
+        else:
+            other.append(pfx)
+    return nets, other
+
+
+def _collapse_prefix_entries(prefixes: List[str]) -> List[str]:
+    """Merge prefix-list entries without changing what they match.
+
+    Duplicates are dropped and complete sets of same-length siblings become one
+    "<supernet> ge <len> le <len>" entry, which matches exactly the same routes.
+    Prefixes of different lengths are left alone (an exact-match entry for a
+    covering prefix does not match the covered one).
+    """
+    nets, other = _ipv4_networks(prefixes)
+    by_len: Dict[int, List[ipaddress.IPv4Network]] = {}
+    for net in nets:
+        by_len.setdefault(net.prefixlen, []).append(net)
+    entries: List[Tuple[ipaddress.IPv4Network, int]] = []
+    for length, group in by_len.items():
+        entries += [(sup, length) for sup in ipaddress.collapse_addresses(group)]
+    entries.sort(key=lambda e: (e[0].network_address, e[0].prefixlen, e[1]))
+    out = [str(sup) if sup.prefixlen == length else f"{sup} ge {length} le {length}" for sup, length in entries]
+    return out + sorted(set(other))
+
+
+def _summary_aggregates(prefixes: List[str]) -> List[str]:
+    """Supernets covering two or more of ``prefixes`` (adjacent or covered), for aggregate-address."""
+    nets, _ = _ipv4_networks(prefixes)
+    nets = sorted(set(nets))
+    out: List[str] = []
+    for sup in ipaddress.collapse_addresses(nets):
+        if sum(1 for net in nets if net.subnet_of(sup)) >= 2:
+            out.append(str(sup))
+    return out
+
+
+# FRR prefix-list sequence numbers are 1..2^32-1
+_PL_SEQ_MAX = 4294967295
+
+
+def _stable_seqs(entries: List[str]) -> Dict[str, int]:
+    """Sequence number per entry, derived from the entry text.
+
+    Only for lists whose entries share one action, where order does not
+    matter: adding or removing an entry leaves every other entry's seq
+    unchanged, so a reload touches just that entry. Hash collisions are
+    resolved by probing upwards in sorted entry order.
+    """
+    seqs: Dict[str, int] = {}
+    taken: Set[int] = set()
+    for entry in sorted(set(entries)):
+        seq = zlib.crc32(entry.encode("utf-8")) % _PL_SEQ_MAX + 1
+        while seq in taken:
+            seq = seq % _PL_SEQ_MAX + 1
+        taken.add(seq)
+        seqs[entry] = seq
+    return seqs
+
+
+def _unique(items: List[str]) -> List[str]:
+    return list(dict.fromkeys(items))
+
+
+def _parse_listen_range(raw: str) -> str:
+    if not raw.strip():
+        return ""
+    try:
+        net = ipaddress.ip_network(raw.strip(), strict=False)
+    except ValueError as e:
+        raise ValueError(f"/global/bgp/ibgp_listen_range: {e}") from e
+    if net.version != 4:
+        raise ValueError("/global/bgp/ibgp_listen_range must be an IPv4 CIDR")
+    return str(net)
+
+
+# BFD timers (milliseconds / packets), used when a transport sets bgp/bfd without them
+BFD_INTERVAL_DEFAULT = 300
+BFD_MULTIPLIER_DEFAULT = 3
+
+
+def _bfd_profile(kind: str, name: str, cfg: Dict[str, str]) -> Optional[Tuple[str, List[str]]]:
+    """Return (profile name, profile lines) for a transport with bgp/bfd, else None."""
+    if cfg.get("bgp/bfd", "false").lower() != "true":
+        return None
+
+    def timer(key: str, default: int, low: int, high: int) -> int:
+        values = _int_fields(cfg.get(key, ""), f"{kind}/{name}/{key}", [(low, high)])
+        return values[0] if values else default
+
+    multiplier = timer("bgp/bfd_multiplier", BFD_MULTIPLIER_DEFAULT, 2, 255)
+    rx = timer("bgp/bfd_receive_interval", BFD_INTERVAL_DEFAULT, 10, 60000)
+    tx = timer("bgp/bfd_transmit_interval", BFD_INTERVAL_DEFAULT, 10, 60000)
+    return f"BFD-{kind}-{name}", [
+        f"detect-multiplier {multiplier}",
+        f"receive-interval {rx}",
+        f"transmit-interval {tx}",
+    ]
+
+
+def _int_fields(raw: str, key: str, bounds: List[Tuple[int, int]]) -> List[int]:
+    """Parse a space-separated list of integers within ``bounds``; empty input gives []."""
+    parts = raw.split()
+    if not parts:
+        return []
+    if len(parts) != len(bounds) or not all(p.isdigit() for p in parts):
+        raise ValueError(f"{key} must be {len(bounds)} integer(s)")
+    values = [int(p) for p in parts]
+    for value, (low, high) in zip(values, bounds):
+        if not low <= value <= high:
+            raise ValueError(f"{key}: {value} not in {low}..{high}")
+    return values
+
+
+# Route-flap dampening parameters: half-life (min), reuse, suppress, max-suppress (min)
+_DAMPENING_BOUNDS = [(1, 45), (1, 20000), (1, 20000), (1, 255)]
+MAXIMUM_PREFIX_THRESHOLD_DEFAULT = "75"
+MAXIMUM_PREFIX_RESTART_DEFAULT = "5"
+
+
+def _maximum_prefix(cfg: Dict[str, str], global_cfg: Dict[str, str]) -> str:
+    """Return the "maximum-prefix ..." arguments for an eBGP transport, or "" when unlimited.
+
+    The limit comes from the transport's bgp/maximum_prefix, else /global/bgp/maximum_prefix.
+    A peer exceeding it is shut down and retried after maximum_prefix_restart minutes,
+    or only logged with maximum_prefix_warning_only.
+    """
+    limit = cfg.get("bgp/maximum_prefix", "").strip() or global_cfg.get("/global/bgp/maximum_prefix", "").strip()
+    if not limit:
+        return ""
+    threshold = global_cfg.get("/global/bgp/maximum_prefix_threshold", "").strip() or MAXIMUM_PREFIX_THRESHOLD_DEFAULT
+    restart = global_cfg.get("/global/bgp/maximum_prefix_restart", "").strip() or MAXIMUM_PREFIX_RESTART_DEFAULT
+    limit_v, threshold_v, restart_v = _int_fields(
+        f"{limit} {threshold} {restart}",
+        "/global/bgp/maximum_prefix*",
+        [(1, 4294967295), (1, 100), (1, 65535)],
+    )
+    if global_cfg.get("/global/bgp/maximum_prefix_warning_only") == "true":
+        return f"{limit_v} {threshold_v} warning-only"
+    return f"{limit_v} {threshold_v} restart {restart_v}"
+
+
+GRACEFUL_RESTART_TIME_DEFAULT = "120"
+GRACEFUL_RESTART_STALEPATH_TIME_DEFAULT = "360"
+OSPF_GRACE_PERIOD_DEFAULT = "120"
+
+
+def _bgp_graceful_restart_lines(global_cfg: Dict[str, str]) -> List[str]:
+    """router bgp statements for graceful restart and update-delay from /global/bgp/."""
+    out: List[str] = []
+    if global_cfg.get("/global/bgp/graceful_restart") == "true":
+        restart_time, stalepath_time = _int_fields(
+            " ".join([
+                global_cfg.get("/global/bgp/graceful_restart_time", "").strip() or GRACEFUL_RESTART_TIME_DEFAULT,
+                global_cfg.get("/global/bgp/graceful_restart_stalepath_time", "").strip()
+                or GRACEFUL_RESTART_STALEPATH_TIME_DEFAULT,
+            ]),
+            "/global/bgp/graceful_restart_*",
+            [(1, 4095), (1, 4095)],
+        )
+        out += [
+            " bgp graceful-restart",
+            f" bgp graceful-restart restart-time {restart_time}",
+            f" bgp graceful-restart stalepath-time {stalepath_time}",
+            # zebra keeps the FIB across daemon restarts (-K/-r in frr/daemons)
+            " bgp graceful-restart preserve-fw-state",
+        ]
+        llgr = _int_fields(
+            global_cfg.get("/global/bgp/llgr_stale_time", ""), "/global/bgp/llgr_stale_time", [(1, 16777215)]
+        )
+        if llgr:
+            out.append(f" bgp long-lived-graceful-restart stale-time {llgr[0]}")
+    update_delay = _int_fields(
+        global_cfg.get("/global/bgp/update_delay", ""), "/global/bgp/update_delay", [(0, 3600)]
+    )
+    if update_delay:
+        out.append(f" update-delay {update_delay[0]}")
+    return out
+
+
+# Latency-aware costs: the watcher's loss-weighted transport RTT (ms) becomes the
+# OSPF cost of the transport interface and lowers the local-preference of routes
+# learned over it by one per LATENCY_LOCAL_PREF_STEP_MS.
+LATENCY_LOCAL_PREF_STEP_MS = 10
+LATENCY_LOCAL_PREF_MIN = 51  # stays above routes from roaming nodes (50)
+
+
+def _latency_local_pref(cost_ms: int) -> int:
+    return max(LATENCY_LOCAL_PREF_MIN, 100 - cost_ms // LATENCY_LOCAL_PREF_STEP_MS)
+
+
+# Top-level statements that open a block; indented lines below belong to it.
+_FRR_BLOCK_PREFIXES = ("route-map ", "interface ", "router ")
+_FRR_BLOCK_STATEMENTS = ("bfd",)
+# Sub-block openers inside a block, mapped to the statement closing them.
+_FRR_SECTION_ENDS = {"address-family ": "exit-address-family", "profile ": "exit"}
+
+
+def _frr_model(frr_conf: str) -> Dict[str, Any]:
+    """Split a rendered frr.conf into stanzas for the watcher's delta apply.
+
+    Returns {"lines": [top-level statements], "blocks": [{"header", "lines",
+    "sections"}]}; "sections" holds address-family and bfd profile sub-blocks.
+    Comments, "!" separators and block-closing "exit" lines are dropped.
+    """
+    lines: List[str] = []
+    blocks: List[Dict[str, Any]] = []
+    block: Optional[Dict[str, Any]] = None
+    section: Optional[Dict[str, Any]] = None
+    for raw in frr_conf.splitlines():
+        text = raw.strip()
+        if not text or text.startswith("!"):
+            continue
+        if not raw[0].isspace():
+            section = None
+            if text == "exit":
+                block = None
+            elif text.startswith(_FRR_BLOCK_PREFIXES) or text in _FRR_BLOCK_STATEMENTS:
+                block = {"header": text, "lines": [], "sections": []}
+                blocks.append(block)
+            else:
+                block = None
+                lines.append(text)
+            continue
+        if block is None:
+            lines.append(text)
+        elif text in _FRR_SECTION_ENDS.values():
+            section = None
+        elif text.startswith(tuple(_FRR_SECTION_ENDS)):
+            section = {"header": text, "lines": []}
+            block["sections"].append(section)
+        elif section is not None:
+            section["lines"].append(text)
+        else:
+            block["lines"].append(text)
+    return {"lines": lines, "blocks": blocks}
+
+
+def generate_frr(
+    node_id: str,
+    node: Dict[str, str],
+    global_cfg: Dict[str, str],
+    all_nodes: Dict[str, str],
+    latency: Optional[Dict[str, int]] = None,
+) -> Dict[str, Any]:
     router_id = node.get(f"/nodes/{node_id}/router_id", "")
     internal_routing = global_cfg.get("/global/internal_routing_system", "ospf")
     ospf_enable = node.get(f"/nodes/{node_id}/ospf/enable") == "true"
@@ -297,6 +578,59 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
     # Parse BGP edge broadcast prefixes (newline-separated)
     bgp_edge_broadcast = sorted(set(split_ml(global_cfg.get("/global/bgp/edge_broadcast", ""))))
 
+    # Control-plane protection: route-flap dampening ("true" for FRR defaults or
+    # "<half-life> <reuse> <suppress> <max-suppress>") and OSPF SPF/LSA throttling
+    dampening_raw = global_cfg.get("/global/bgp/dampening", "").strip()
+    if dampening_raw in ("", "false"):
+        dampening = ""
+    elif dampening_raw == "true":
+        dampening = "bgp dampening"
+    else:
+        dampening = "bgp dampening " + " ".join(
+            str(v) for v in _int_fields(dampening_raw, "/global/bgp/dampening", _DAMPENING_BOUNDS)
+        )
+    spf_throttle = _int_fields(
+        node.get(f"/nodes/{node_id}/ospf/spf_throttle", ""),
+        f"/nodes/{node_id}/ospf/spf_throttle",
+        [(0, 600000)] * 3,
+    )
+    lsa_throttle = _int_fields(
+        node.get(f"/nodes/{node_id}/ospf/lsa_throttle", ""),
+        f"/nodes/{node_id}/ospf/lsa_throttle",
+        [(0, 5000)],
+    )
+    ospf_graceful_restart = node.get(f"/nodes/{node_id}/ospf/graceful_restart") == "true"
+    ospf_grace_period = 0
+    if ospf_graceful_restart:
+        ospf_grace_period = _int_fields(
+            node.get(f"/nodes/{node_id}/ospf/grace_period", "").strip() or OSPF_GRACE_PERIOD_DEFAULT,
+            f"/nodes/{node_id}/ospf/grace_period",
+            [(1, 1800)],
+        )[0]
+    lsa_arrival = _int_fields(
+        node.get(f"/nodes/{node_id}/ospf/lsa_min_arrival", ""),
+        f"/nodes/{node_id}/ospf/lsa_min_arrival",
+        [(0, 600000)],
+    )
+
+    # iBGP neighbors from the fleet index (indexed once per snapshot)
+    # With route reflectors, clients only peer with the reflectors.
+    is_route_reflector = node.get(f"/nodes/{node_id}/bgp/route_reflector") == "true"
+    cluster_id = global_cfg.get("/global/bgp/cluster_id", "").strip()
+    # Dynamic iBGP: accept peers from the overlay prefix without per-peer config
+    listen_range = _parse_listen_range(global_cfg.get("/global/bgp/ibgp_listen_range", ""))
+    listen_limit = _int_fields(
+        global_cfg.get("/global/bgp/ibgp_listen_limit", "").strip() or IBGP_LISTEN_LIMIT_DEFAULT,
+        "/global/bgp/ibgp_listen_limit",
+        [(1, 65535)],
+    )[0]
+    neighbors: Dict[str, Dict[str, str]] = {}
+    rr_mode = False
+    if internal_routing == "bgp" and bgp_enable:
+        rr_mode, neighbors = _route_reflector_topology(
+            is_route_reflector, _internal_bgp_neighbors(node_id, fleet_index(all_nodes))
+        )
+
     # Collect neighbors with BGP control flags
     ovpn = _parse_openvpn(node_id, node)
     wg = _parse_wireguard(node_id, node)
@@ -316,6 +650,29 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
     has_no_forward = any(nf for _, (_, nf) in bgp_control_peers.items() if nf)
     has_no_transit = any(nt for _, (nt, _) in bgp_control_peers.items() if nt)
 
+    # Measured transports ("<kind>/<name>" -> cost ms), probed by the watcher
+    # Transports are only probed while latency routing is on
+    latency_routing = global_cfg.get("/global/latency_routing") == "true"
+    latency_costs = (latency or {}) if latency_routing else {}
+    latency_targets: Dict[str, Dict[str, str]] = {}
+    iface_costs: Dict[str, int] = {}
+    latency_in: Dict[str, Tuple[str, int]] = {}  # peer_ip -> (wrapped inbound route-map, local-preference)
+    for kind, name, cfg, dev in _iter_bgp_transports(ovpn, wg):
+        peer_ip = cfg.get("bgp/peer_ip", "")
+        if cfg.get("enable") != "true" or not peer_ip:
+            continue
+        key = f"{kind}/{name}"
+        if latency_routing:
+            latency_targets[key] = {"dev": dev, "peer_ip": peer_ip}
+        if key not in latency_costs:
+            continue
+        iface_costs[dev] = min(65535, max(1, int(latency_costs[key])))
+        if _bgp_enabled(cfg) and cfg.get("bgp/peer_asn", ""):
+            latency_in[peer_ip] = (
+                _inbound_route_map(peer_ip, cfg, has_no_forward),
+                _latency_local_pref(int(latency_costs[key])),
+            )
+
     if internal_routing == "bgp":
         ospf_enable = False
 
@@ -344,6 +701,16 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
     private_lans = sorted(set(split_ml(node.get(f"/nodes/{node_id}/private_lan", "")))) if inject_private_lan else []
     access_networks = _parse_access_network(node_id, node)
 
+    # Prefix aggregation: prefix-list entries are collapsed unless exact_prefixes is set;
+    # summary-only aggregates for the public networks are opt-in.
+    exact_prefixes = node.get(f"/nodes/{node_id}/bgp/exact_prefixes") == "true"
+    aggregate_summary = node.get(f"/nodes/{node_id}/bgp/aggregate_summary") == "true" and not exact_prefixes
+    if exact_prefixes:
+        lan_entries, private_lan_entries = lans, private_lans
+    else:
+        lan_entries = _collapse_prefix_entries(lans)
+        private_lan_entries = _collapse_prefix_entries(private_lans)
+
     lines: List[str] = [
         "frr defaults traditional",
         "service integrated-vtysh-config",
@@ -358,10 +725,9 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
     # FRR will redistribute connected routes and filter by these prefix lists
     # Only routes that are actually connected (in routing table) will be advertised
     if lans:
-        seq = 10
-        for pfx in lans:
-            lines.append(f"ip prefix-list PL-OSPF-LAN seq {seq} permit {pfx}")
-            seq += 10
+        seqs = _stable_seqs(lan_entries)
+        for pfx in lan_entries:
+            lines.append(f"ip prefix-list PL-OSPF-LAN seq {seqs[pfx]} permit {pfx}")
         lines.append("")
         lines.append("route-map RM-OSPF-CONN permit 10")
         lines.append(" match ip address prefix-list PL-OSPF-LAN")
@@ -369,10 +735,9 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
         lines.append("")
 
     if private_lans:
-        seq = 10
-        for pfx in private_lans:
-            lines.append(f"ip prefix-list PL-OSPF-PRIVATE-LAN seq {seq} permit {pfx}")
-            seq += 10
+        seqs = _stable_seqs(private_lan_entries)
+        for pfx in private_lan_entries:
+            lines.append(f"ip prefix-list PL-OSPF-PRIVATE-LAN seq {seqs[pfx]} permit {pfx}")
         lines.append("")
         lines.append("route-map RM-OSPF-CONN-PRIVATE permit 10")
         lines.append(" match ip address prefix-list PL-OSPF-PRIVATE-LAN")
@@ -399,10 +764,9 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
     lines.append("")
 
     if private_lans:
-        seq = 10
-        for pfx in private_lans:
-            lines.append(f"ip prefix-list PL-PRIVATE-LAN seq {seq} permit {pfx}")
-            seq += 10
+        seqs = _stable_seqs(private_lan_entries)
+        for pfx in private_lan_entries:
+            lines.append(f"ip prefix-list PL-PRIVATE-LAN seq {seqs[pfx]} permit {pfx}")
         lines.append("")
 
     # Route maps to prevent private_lan from being advertised to external BGP
@@ -508,12 +872,12 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
     # Roaming nodes should be deprioritized for transit traffic
     # Routes learned from them will have lower local-preference
     # This allows them to be used as backup paths but not preferred for transit
-    has_roaming_ibgp = False
-    if internal_routing == "bgp" and bgp_enable:
-        neighbors = _internal_bgp_neighbors(node_id, all_nodes)
-        has_roaming_ibgp = any(info.get("is_roaming") == "true" for info in neighbors.values())
+    has_roaming_ibgp = any(info.get("is_roaming") == "true" for info in neighbors.values())
+    # Peers accepted through the listen range are not known until the next render:
+    # treat them as roaming so an unknown node never becomes the preferred path
+    use_listen_range = internal_routing == "bgp" and bool(listen_range) and bool(router_id)
 
-    if has_roaming_ibgp:
+    if has_roaming_ibgp or use_listen_range:
         # Inbound route-map for roaming iBGP neighbors: lower local-preference
         # Default local-preference is 100, we set roaming routes to 50
         # This makes them less preferred but still available as backup
@@ -524,16 +888,40 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
         lines.append("!")
         lines.append("")
 
+    # Latency wrappers: the peer's usual inbound policy, then its local-preference
+    if bgp_enable and local_as:
+        for peer_ip, (rm_in, local_pref) in sorted(latency_in.items()):
+            peer_name = peer_ip.replace(".", "-")
+            lines.append(f"route-map RM-BGP-IN-LAT-{peer_name} permit 10")
+            lines.append(f" call {rm_in}")
+            lines.append(f" set local-preference {local_pref}")
+            lines.append("!")
+            lines.append("")
+
     if ospf_enable:
         ospf_area = node.get(f"/nodes/{node_id}/ospf/area", "0")
         for iface in active_ifaces:
             lines.append(f"interface {iface}")
             lines.append(f" ip ospf area {ospf_area}")
             lines.append(" ip ospf network broadcast")
+            if iface in iface_costs:
+                lines.append(f" ip ospf cost {iface_costs[iface]}")
             lines.append("!")
         lines.append("router ospf")
         if router_id:
             lines.append(f" ospf router-id {router_id}")
+        # Bound SPF runs and LSA origination so a flapping tunnel cannot pin ospfd
+        if spf_throttle:
+            lines.append(" timers throttle spf {} {} {}".format(*spf_throttle))
+        if lsa_throttle:
+            lines.append(f" timers throttle lsa all {lsa_throttle[0]}")
+        if lsa_arrival:
+            lines.append(f" timers lsa min-arrival {lsa_arrival[0]}")
+        # Grace LSAs are opaque; neighbors keep forwarding through a restarting ospfd
+        if ospf_graceful_restart:
+            lines.append(" capability opaque")
+            lines.append(f" graceful-restart grace-period {ospf_grace_period}")
+            lines.append(" graceful-restart helper enable")
         # Passive all interfaces except active_ifaces
         if active_ifaces:
             lines.append(" passive-interface default")
@@ -550,13 +938,34 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
             lines.append(" redistribute bgp route-map RM-BGP-TO-OSPF")
         lines += ["!", ""]
 
+    # BFD profiles for eBGP transports with bgp/bfd; a dead tunnel then drops
+    # its session within interval * multiplier instead of the BGP hold time.
+    bfd_profiles: Dict[str, str] = {}  # peer_ip -> profile name
+    if bgp_enable and local_as:
+        bfd_lines: List[str] = []
+        for kind, name, cfg, dev in _iter_bgp_transports(ovpn, wg):
+            if cfg.get("enable") != "true" or not _bgp_enabled(cfg):
+                continue
+            peer_ip = cfg.get("bgp/peer_ip", "")
+            profile = _bfd_profile(kind, name, cfg)
+            if not peer_ip or not cfg.get("bgp/peer_asn", "") or profile is None:
+                continue
+            profile_name, profile_lines = profile
+            bfd_profiles[peer_ip] = profile_name
+            bfd_lines.append(f" profile {profile_name}")
+            bfd_lines += [f"  {line}" for line in profile_lines]
+            bfd_lines.append(" exit")
+        if bfd_lines:
+            lines += ["bfd"] + bfd_lines + ["exit", "!", ""]
+
     if bgp_enable and local_as:
         lines.append(f"router bgp {local_as}")
         if router_id:
             lines.append(f" bgp router-id {router_id}")
+        # Peers keep our routes while bgpd restarts; update-delay holds the
+        # first best-path run until peers have sent their tables.
+        lines += _bgp_graceful_restart_lines(global_cfg)
 
-        ovpn = _parse_openvpn(node_id, node)
-        wg = _parse_wireguard(node_id, node)
         self_is_exit = _node_is_exit(ovpn, wg)
         for kind, name, cfg, dev in _iter_bgp_transports(ovpn, wg):
             if cfg.get("enable") != "true":
@@ -571,9 +980,22 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
                 lines.append(f" neighbor {peer_ip} remote-as {peer_asn}")
                 lines.append(f" neighbor {peer_ip} description {desc}")
                 lines.append(f" neighbor {peer_ip} update-source {update_source}")
+                if peer_ip in bfd_profiles:
+                    lines.append(f" neighbor {peer_ip} bfd")
+                    lines.append(f" neighbor {peer_ip} bfd profile {bfd_profiles[peer_ip]}")
+        if internal_routing == "bgp" and rr_mode and is_route_reflector and cluster_id:
+            # Redundant reflectors sharing a cluster-id drop each other's reflected routes
+            lines.append(f" bgp cluster-id {cluster_id}")
+        if use_listen_range:
+            # Nodes that joined after this config was rendered connect through the
+            # listen range; known nodes stay explicit neighbors below.
+            lines.append(f" neighbor {IBGP_PEER_GROUP} peer-group")
+            lines.append(f" neighbor {IBGP_PEER_GROUP} remote-as internal")
+            lines.append(f" neighbor {IBGP_PEER_GROUP} update-source {router_id}")
+            lines.append(f" bgp listen limit {listen_limit}")
+            lines.append(f" bgp listen range {listen_range} peer-group {IBGP_PEER_GROUP}")
         ibgp_neighbors: List[Dict[str, str]] = []
         if internal_routing == "bgp":
-            neighbors = _internal_bgp_neighbors(node_id, all_nodes)
             for _nid, info in neighbors.items():
                 peer_ip = info["router_id"]
                 lines.append(f" neighbor {peer_ip} remote-as internal")
@@ -582,22 +1004,27 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
                 ibgp_neighbors.append(info)
         lines.append(" address-family ipv4 unicast")
         lines.append(f"  maximum-paths {max_paths}")
-        for pfx in lans:
-            lines.append(f"  network {pfx}")
-        for pfx in access_networks:
-            lines.append(f"  network {pfx}")
+        # LANs, access networks, private LANs (iBGP only), network mappings (network_a)
+        # and, on exit nodes, edge broadcast prefixes; each announced once
+        public_networks = lans + access_networks + advertised_networks
+        networks = lans + access_networks
         if internal_routing == "bgp":
-            for pfx in private_lans:
-                lines.append(f"  network {pfx}")
-        # Advertise network mappings (network_a)
-        for pfx in advertised_networks:
-            lines.append(f"  network {pfx}")
-        # Broadcast edge prefixes if this node is an exit node
+            networks += private_lans
+        networks += advertised_networks
         if self_is_exit and bgp_edge_broadcast:
-            for pfx in bgp_edge_broadcast:
-                lines.append(f"  network {pfx}")
+            networks += bgp_edge_broadcast
+        for pfx in _unique(networks):
+            lines.append(f"  network {pfx}")
+        # Announce one summary instead of adjacent/covered public networks.
+        # Private LANs and edge broadcast prefixes are never summarized.
+        if aggregate_summary:
+            for pfx in _summary_aggregates(public_networks):
+                lines.append(f"  aggregate-address {pfx} summary-only")
         if ospf_enable:
             lines.append("  redistribute ospf route-map RM-OSPF-TO-BGP")
+        # Dampening only applies to eBGP-learned routes
+        if dampening:
+            lines.append(f"  {dampening}")
         for _kind, name, cfg, dev in _iter_bgp_transports(ovpn, wg):
             if cfg.get("enable") != "true":
                 continue
@@ -611,20 +1038,17 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
                 lines.append(f"  neighbor {peer_ip} activate")
                 if weight:
                     lines.append(f"  neighbor {peer_ip} weight {weight}")
+                maximum_prefix = _maximum_prefix(cfg, global_cfg)
+                if maximum_prefix:
+                    lines.append(f"  neighbor {peer_ip} maximum-prefix {maximum_prefix}")
 
-                # Determine which inbound route-map to use
+                # Inbound route-map, wrapped when latency sets the local-preference
                 no_transit, no_forward = _get_bgp_control_flags(cfg)
-                if no_transit:
-                    # Use peer-specific inbound route-map with AS_PATH filtering
+                if peer_ip in latency_in:
                     peer_name = peer_ip.replace(".", "-")
-                    lines.append(f"  neighbor {peer_ip} route-map RM-BGP-IN-{peer_name} in")
-                elif has_no_forward and not no_forward:
-                    # This is a normal eBGP peer - tag routes for no_forward filtering
-                    # Use wrapper route-map that tags eBGP routes
-                    lines.append(f"  neighbor {peer_ip} route-map RM-BGP-IN-TAG-EBGP in")
+                    lines.append(f"  neighbor {peer_ip} route-map RM-BGP-IN-LAT-{peer_name} in")
                 else:
-                    # Standard inbound filter
-                    lines.append(f"  neighbor {peer_ip} route-map RM-BGP-IN in")
+                    lines.append(f"  neighbor {peer_ip} route-map {_inbound_route_map(peer_ip, cfg, has_no_forward)} in")
 
                 # Determine which outbound route-map to use based on BGP control flags
                 if no_forward:
@@ -650,6 +1074,17 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
                 if (bgp_transit_all or (bgp_transit_as_list and peer_asn in bgp_transit_as_list)) and not no_forward:
                     lines.append(f"  neighbor {peer_ip} next-hop-self")
 
+        if use_listen_range:
+            lines.append(f"  neighbor {IBGP_PEER_GROUP} activate")
+            lines.append(f"  neighbor {IBGP_PEER_GROUP} route-map RM-BGP-IN-ROAMING in")
+            if private_lans:
+                lines.append(f"  neighbor {IBGP_PEER_GROUP} route-map RM-BGP-OUT-INTERNAL out")
+            else:
+                lines.append(f"  neighbor {IBGP_PEER_GROUP} route-map RM-BGP-OUT out")
+            lines.append(f"  neighbor {IBGP_PEER_GROUP} next-hop-self")
+            if rr_mode and is_route_reflector:
+                lines.append(f"  neighbor {IBGP_PEER_GROUP} route-reflector-client")
+
         for info in ibgp_neighbors:
             peer_ip = info["router_id"]
             is_roaming = info.get("is_roaming") == "true"
@@ -673,6 +1108,10 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
 
             # Always use next-hop-self for iBGP to ensure proper route propagation
             lines.append(f"  neighbor {peer_ip} next-hop-self")
+
+            # Reflectors reflect routes to every non-reflector peer
+            if rr_mode and is_route_reflector and info.get("is_rr") != "true":
+                lines.append(f"  neighbor {peer_ip} route-reflector-client")
         lines.append(" exit-address-family")
         lines += ["!", ""]
 
@@ -681,18 +1120,22 @@ def generate_frr(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str],
 
     return {
         "frr_conf": frr_conf,
+        "frr_model": _frr_model(frr_conf),
         "network_mappings": network_mappings,
         "nat_rules": nat_rules,
+        "latency_targets": latency_targets,
     }
 
 
-def main() -> None:
-    payload = read_input()
+def generate(payload: Dict[str, Any]) -> Dict[str, Any]:
     node_id = payload["node_id"]
     node = payload["node"]
     global_cfg = payload["global"]
-    result = generate_frr(node_id, node, global_cfg, payload.get("all_nodes", {}))
-    write_output(result)
+    return generate_frr(node_id, node, global_cfg, payload.get("all_nodes", {}), payload.get("latency"))
+
+
+def main() -> None:
+    write_output(generate(read_input()))
 
 
 if __name__ == "__main__":
@@ -60,11 +60,7 @@ def _refresh_minutes(node_id: str, node: Dict[str, str]) -> int:
     return val
 
 
-def main() -> None:
-    payload = read_input()
-    node_id = payload["node_id"]
-    node = payload["node"]
-    global_cfg = payload["global"]
+def generate_mosdns(node_id: str, node: Dict[str, str], global_cfg: Dict[str, str]) -> Dict[str, Any]:
     rules_raw = global_cfg.get("/global/mosdns/rule_files", "")
     rules = _parse_json_map(rules_raw) if rules_raw else {}
 
@@ -74,7 +70,7 @@ def main() -> None:
     ddns_text = global_cfg.get("/global/mosdns/ddns", "")
     global_text = global_cfg.get("/global/mosdns/global", "")
 
-    out = {
+    return {
         "config_text": _build_config_text(global_cfg),
         "rules": rules,
         "refresh_minutes": _refresh_minutes(node_id, node),
@@ -83,7 +79,14 @@ def main() -> None:
         "ddns": ddns_text,
         "global": global_text,
     }
-    write_output(out)
+
+
+def generate(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return generate_mosdns(payload["node_id"], payload["node"], payload["global"])
+
+
+def main() -> None:
+    write_output(generate(read_input()))
 
 
 if __name__ == "__main__":
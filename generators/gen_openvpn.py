@@ -109,10 +109,7 @@ def build_config(name: str, cfg: Dict[str, str]) -> Tuple[str, List[Dict[str, An
     return "\n".join(lines).strip() + "\n", files
 
 
-def main() -> None:
-    payload = read_input()
-    node_id = payload["node_id"]
-    node = payload["node"]
+def generate_openvpn(node_id: str, node: Dict[str, str]) -> Dict[str, Any]:
     ovpn = parse_openvpn(node_id, node)
     instances: List[Dict[str, Any]] = []
     for name, cfg in ovpn.items():
@@ -125,7 +122,15 @@ def main() -> None:
             "config": config_text,
             "files": files,
         })
-    write_output({"instances": instances})
+    return {"instances": instances}
+
+
+def generate(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return generate_openvpn(payload["node_id"], payload["node"])
+
+
+def main() -> None:
+    write_output(generate(read_input()))
 
 
 if __name__ == "__main__":
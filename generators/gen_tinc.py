@@ -1,7 +1,7 @@
 from typing import Any, Dict, List
 import ipaddress
 
-from common import read_input, write_output, split_ml
+from common import Fleet, fleet_index, read_input, write_output, split_ml
 
 
 def _ipv4_to_subnet(ipv4: str) -> List[str]:
@@ -23,21 +23,12 @@ def _ipv4_to_subnet(ipv4: str) -> List[str]:
     return subnets
 
 
-def _parse_tinc_nodes(nodes: Dict[str, str]) -> Dict[str, Dict[str, str]]:
-    base = "/nodes/"
+def _parse_tinc_nodes(fleet: Fleet) -> Dict[str, Dict[str, str]]:
     out: Dict[str, Dict[str, str]] = {}
-    for k, v in nodes.items():
-        if not k.startswith(base):
-            continue
-        rest = k[len(base):]
-        if "/tinc/" not in rest:
-            continue
-        node_id, tail = rest.split("/", 1)
-        if not tail.startswith("tinc/"):
-            continue
-        key = tail[len("tinc/"):]
-        out.setdefault(node_id, {})
-        out[node_id][key] = v
+    for view in fleet:
+        cfg = view.subtree("tinc")
+        if cfg:
+            out[view.node_id] = cfg
     return out
 
 
@@ -122,7 +113,7 @@ def generate_tinc(node_id: str, node: Dict[str, str], all_nodes: Dict[str, str],
 
     files: List[Dict[str, Any]] = []
 
-    nodes = _parse_tinc_nodes(all_nodes)
+    nodes = _parse_tinc_nodes(fleet_index(all_nodes))
     connect_to: List[str] = []
     for peer_id, cfg in nodes.items():
         if cfg.get("enable") != "true":
@@ -247,14 +238,16 @@ def generate_tinc(node_id: str, node: Dict[str, str], all_nodes: Dict[str, str],
     return {"files": files, "netname": netname}
 
 
-def main() -> None:
-    payload = read_input()
+def generate(payload: Dict[str, Any]) -> Dict[str, Any]:
     node_id = payload["node_id"]
     node = payload["node"]
     all_nodes = payload["all_nodes"]
     global_cfg = payload["global"]
-    out = generate_tinc(node_id, node, all_nodes, global_cfg)
-    write_output(out)
+    return generate_tinc(node_id, node, all_nodes, global_cfg)
+
+
+def main() -> None:
+    write_output(generate(read_input()))
 
 
 if __name__ == "__main__":
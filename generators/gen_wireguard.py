@@ -85,10 +85,7 @@ def build_config(name: str, cfg: Dict[str, str]) -> str:
     return "\n".join(lines).strip() + "\n"
 
 
-def main() -> None:
-    payload = read_input()
-    node_id = payload["node_id"]
-    node = payload["node"]
+def generate_wireguard(node_id: str, node: Dict[str, str]) -> Dict[str, Any]:
     wg = parse_wireguard(node_id, node)
     instances: List[Dict[str, Any]] = []
     for name, cfg in wg.items():
@@ -101,7 +98,15 @@ def main() -> None:
             "dev": dev,
             "config": config_text,
         })
-    write_output({"instances": instances})
+    return {"instances": instances}
+
+
+def generate(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return generate_wireguard(payload["node_id"], payload["node"])
+
+
+def main() -> None:
+    write_output(generate(read_input()))
 
 
 if __name__ == "__main__":
@@ -2,6 +2,7 @@
 import time
 import hashlib
 import glob
+import importlib
 import subprocess
 import json
 import shutil
@@ -10,7 +11,11 @@ import random
 import signal
 import re
 import socket
+import sys
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Dict, Any, List, Optional, Tuple, Set
 
 import etcd3
@@ -21,15 +26,28 @@ from urllib.parse import urlparse
 
 NODE_ID = os.environ["NODE_ID"]
 TPROXY_PORT = 7893
+TPROXY_MARK = "0x1"
+TPROXY_ROUTE_TABLE = "100"
 MOSDNS_SOCKS_PORT = 7891
 CLASH_HTTP_PORT = 7890
 CLASH_API_PORT = 9090
 CLASH_API_SECRET = ""
 GEN_DIR = "/generators"
+# "inprocess" imports generator modules once and calls them directly; "subprocess"
+# runs every generation in a fresh interpreter (isolation fallback).
+GENERATOR_MODE = os.environ.get("GENERATOR_MODE", "inprocess").strip().lower()
+# Memoized generator outputs (LRU, persisted across watcher restarts; 0 entries disables)
+GENERATOR_CACHE_PATH = os.environ.get("GENERATOR_CACHE", "/run/meduza/generator-cache.json")
+GENERATOR_CACHE_SIZE = max(0, int(os.environ.get("GENERATOR_CACHE_SIZE", "64")))
 
 # IPSet for proxy server exclusions
 PROXY_IPSET_NAME = "clash_proxy_ips"
 
+# Packet rules for port forwards, network mapping and TPROXY: "iptables" (owned
+# chains) or "nftables" (one owned table of sets and maps, applied with nft -f)
+FIREWALL_BACKEND = os.environ.get("FIREWALL_BACKEND", "iptables").strip().lower()
+NFT_TABLE = "meduza"
+
 # /updated/<NODE_ID>/...
 UPDATE_BASE = f"/updated/{NODE_ID}"
 UPDATE_LAST_KEY = f"{UPDATE_BASE}/last"      # persistent timestamp
@@ -43,6 +61,8 @@ UPDATE_TTL_SECONDS = int(os.environ.get("UPDATE_TTL_SECONDS", "60"))
 OPENVPN_STATUS_INTERVAL = int(os.environ.get("OPENVPN_STATUS_INTERVAL", "10"))
 WIREGUARD_STATUS_INTERVAL = int(os.environ.get("WIREGUARD_STATUS_INTERVAL", "10"))
 SUPERVISOR_RETRY_INTERVAL = int(os.environ.get("SUPERVISOR_RETRY_INTERVAL", "30"))
+# Prometheus text metrics endpoint ("host:port"; empty disables)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1:9464").strip()
 
 
 def sha(obj: Any) -> str:
@@ -57,6 +77,128 @@ def now_utc_iso() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+0000")
 
 
+# ---------- metrics ----------
+_METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms rendered in Prometheus text format."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._values: Dict[str, Dict[Tuple[Tuple[str, str], ...], Any]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        with self._lock:
+            self._meta[name] = (kind, help_text)
+            self._values.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, {})[key] = float(value)
+
+    def remove(self, name: str, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.get(name, {}).pop(key, None)
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = {"buckets": [0] * len(_METRIC_BUCKETS), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(_METRIC_BUCKETS):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def render(self) -> str:
+        def num(v: float) -> str:
+            return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+        def esc(v: Any) -> str:
+            return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def fmt(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+            items = list(labels) + ([extra] if extra else [])
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+        lines: List[str] = []
+        with self._lock:
+            for name in sorted(self._values):
+                kind, help_text = self._meta.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, val in sorted(self._values[name].items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{fmt(labels)} {num(val)}")
+                        continue
+                    for bound, count in zip(_METRIC_BUCKETS, val["buckets"]):
+                        lines.append(f"{name}_bucket{fmt(labels, ('le', f'{bound:g}'))} {count}")
+                    lines.append(f"{name}_bucket{fmt(labels, ('le', '+Inf'))} {val['count']}")
+                    lines.append(f"{name}_sum{fmt(labels)} {num(val['sum'])}")
+                    lines.append(f"{name}_count{fmt(labels)} {val['count']}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("meduza_reconcile_total", "counter", "Reconcile passes by result.")
+metrics.describe("meduza_reconcile_skipped_total", "counter", "Reconciles skipped because the config snapshot was unchanged.")
+metrics.describe("meduza_reconcile_duration_seconds", "histogram", "Duration of a reconcile pass.")
+metrics.describe("meduza_reconcile_last_timestamp_seconds", "gauge", "Unix time the last reconcile pass finished.")
+metrics.describe("meduza_reconcile_domain_duration_seconds", "histogram", "Duration of each domain task.")
+metrics.describe("meduza_reconcile_domain_last_duration_seconds", "gauge", "Duration of each domain task in the last reconcile.")
+metrics.describe("meduza_reconcile_domain_subprocesses", "gauge", "Subprocesses spawned by each domain task in the last reconcile.")
+metrics.describe("meduza_reconcile_domain_applied_total", "counter", "Domain tasks that applied changes.")
+metrics.describe("meduza_reconcile_domain_errors_total", "counter", "Domain tasks that raised.")
+metrics.describe("meduza_subprocess_total", "counter", "Subprocesses spawned, by domain task (\"other\" outside reconcile).")
+metrics.describe("meduza_generator_duration_seconds", "histogram", "Generator run time.")
+metrics.describe("meduza_generator_errors_total", "counter", "Generator failures.")
+metrics.describe("meduza_generator_cache_total", "counter", "Generator output cache lookups by result.")
+metrics.describe("meduza_tunnel_rtt_seconds", "gauge", "Smoothed RTT of each OpenVPN/WireGuard transport.")
+metrics.describe("meduza_tunnel_loss_ratio", "gauge", "Smoothed probe loss of each OpenVPN/WireGuard transport.")
+metrics.describe("meduza_frr_up", "gauge", "1 when vtysh answers (zebra running).")
+metrics.describe("meduza_frr_peer_up", "gauge", "1 when a BGP session is Established / an OSPF neighbor is Full.")
+metrics.describe("meduza_frr_peer_transitions_total", "counter", "Peer state changes seen by the FRR status poller.")
+metrics.describe("meduza_frr_bgp_prefixes_received", "gauge", "Prefixes accepted from each BGP peer.")
+metrics.describe("meduza_frr_bgp_prefixes_sent", "gauge", "Prefixes advertised to each BGP peer.")
+metrics.describe("meduza_frr_bgp_connections_dropped", "gauge", "Session drops of each BGP peer since bgpd started (FRR counter).")
+metrics.describe("meduza_frr_rib_routes", "gauge", "IPv4 RIB routes by protocol.")
+metrics.describe("meduza_frr_fib_routes", "gauge", "IPv4 routes installed in the FIB.")
+metrics.describe("meduza_frr_convergence_seconds", "gauge", "Time from the last FRR apply until every peer was up.")
+metrics.describe("meduza_frr_apply_total", "counter", "FRR config applies by mode (delta, restart or full reload).")
+metrics.describe("meduza_etcd_request_duration_seconds", "histogram", "Latency of etcd calls made through _etcd_call().")
+metrics.describe("meduza_etcd_errors_total", "counter", "etcd call errors by exception type.")
+metrics.describe("meduza_etcd_failovers_total", "counter", "etcd endpoint failovers.")
+
+# Domain task running on the current thread, for attributing subprocesses.
+_metrics_ctx = threading.local()
+
+
+def _metrics_audit_hook(event: str, _args: Any) -> None:
+    if event == "subprocess.Popen":
+        domain = getattr(_metrics_ctx, "domain", None)
+        if domain is not None:
+            _metrics_ctx.subprocesses += 1
+        metrics.inc("meduza_subprocess_total", domain=domain or "other")
+
+
+sys.addaudithook(_metrics_audit_hook)
+
+
 def _parse_etcd_endpoint(raw: str) -> Dict[str, Any]:
     raw = raw.strip()
     if not raw:
@@ -69,28 +211,98 @@ def _parse_etcd_endpoint(raw: str) -> Dict[str, Any]:
     return {"host": u.hostname, "port": u.port}
 
 
-_first_endpoint = _parse_etcd_endpoint(os.environ["ETCD_ENDPOINTS"].split(",")[0])
+_etcd_endpoints = [
+    _parse_etcd_endpoint(raw) for raw in os.environ["ETCD_ENDPOINTS"].split(",") if raw.strip()
+]
 _etcd_lock = threading.Lock()
 etcd = None
+_etcd_endpoint: Optional[Dict[str, Any]] = None
+
+ETCD_TIMEOUT = float(os.environ.get("ETCD_TIMEOUT", "5"))
+ETCD_PROBE_TIMEOUT = float(os.environ.get("ETCD_PROBE_TIMEOUT", "2"))
+# Keepalive pings detect a dead member on idle channels (long-running watches)
+# instead of waiting for TCP to time out.
+ETCD_GRPC_OPTIONS = [
+    ("grpc.keepalive_time_ms", int(os.environ.get("ETCD_KEEPALIVE_TIME_MS", "10000"))),
+    ("grpc.keepalive_timeout_ms", int(os.environ.get("ETCD_KEEPALIVE_TIMEOUT_MS", "5000"))),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
 
 
-def _new_etcd_client():
+def _endpoint_name(ep: Optional[Dict[str, Any]]) -> str:
+    return f"{ep['host']}:{ep['port']}" if ep else "-"
+
+
+def _new_etcd_client(ep: Dict[str, Any], timeout: float = ETCD_TIMEOUT):
     return etcd3.client(
-        host=_first_endpoint["host"],
-        port=_first_endpoint["port"],
+        host=ep["host"],
+        port=ep["port"],
         ca_cert=os.environ["ETCD_CA"],
         cert_cert=os.environ["ETCD_CERT"],
         cert_key=os.environ["ETCD_KEY"],
         user=os.environ["ETCD_USER"],
         password=os.environ["ETCD_PASS"],
-        timeout=5,
+        timeout=timeout,
+        grpc_options=ETCD_GRPC_OPTIONS,
     )
 
 
-def _reset_etcd() -> None:
-    global etcd
+def _probe_endpoint(ep: Dict[str, Any]) -> Optional[Tuple[float, Any]]:
+    """Connect to one member and time a linearizable read. Returns (latency, client) or None."""
+    client = None
+    try:
+        client = _new_etcd_client(ep, timeout=ETCD_PROBE_TIMEOUT)
+        start = time.monotonic()
+        client.get_response("/commit")
+        latency = time.monotonic() - start
+        client.timeout = ETCD_TIMEOUT
+        return latency, client
+    except Exception as e:
+        print(f"[etcd] probe {_endpoint_name(ep)} failed: {e}", flush=True)
+        if client is not None:
+            try:
+                client.close()
+            except Exception:
+                pass
+        return None
+
+
+def _select_etcd_client(avoid: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], Any]:
+    """Probe all endpoints and return the lowest-latency healthy one.
+
+    ``avoid`` (the member that just failed) is only used when nothing else is healthy.
+    """
+    with ThreadPoolExecutor(max_workers=len(_etcd_endpoints)) as pool:
+        results = list(zip(_etcd_endpoints, pool.map(_probe_endpoint, _etcd_endpoints)))
+    healthy = sorted(
+        ((res[0], ep, res[1]) for ep, res in results if res is not None),
+        key=lambda item: (item[1] == avoid, item[0]),
+    )
+    if not healthy:
+        raise RuntimeError(f"no healthy etcd endpoint among {len(_etcd_endpoints)} configured")
+    latency, ep, client = healthy[0]
+    for _lat, _ep, other in healthy[1:]:
+        try:
+            other.close()
+        except Exception:
+            pass
+    print(f"[etcd] using {_endpoint_name(ep)} (latency={latency * 1000:.1f}ms, healthy={len(healthy)}/{len(_etcd_endpoints)})", flush=True)
+    return ep, client
+
+
+def _reset_etcd(failed_client: Any = None) -> None:
+    """Replace the shared client.
+
+    With ``failed_client`` this is a failover: it is skipped if another thread
+    already replaced that client, and the failed member is avoided when possible.
+    """
+    global etcd, _etcd_endpoint
     with _etcd_lock:
-        etcd = _new_etcd_client()
+        if failed_client is not None and etcd is not failed_client:
+            return
+        avoid = _etcd_endpoint if failed_client is not None else None
+        _etcd_endpoint, etcd = _select_etcd_client(avoid=avoid)
 
 
 def _ensure_etcd() -> None:
@@ -99,18 +311,46 @@ def _ensure_etcd() -> None:
         _reset_etcd()
 
 
+def _is_failover_error(e: Exception) -> bool:
+    if isinstance(e, (etcd3.exceptions.ConnectionFailedError, etcd3.exceptions.ConnectionTimeoutError)):
+        return True
+    return isinstance(e, grpc.RpcError) and e.code() in (StatusCode.UNAVAILABLE, StatusCode.DEADLINE_EXCEEDED)
+
+
 def _etcd_call(fn):
+    start = time.monotonic()
+    try:
+        return _etcd_call_with_failover(fn)
+    except Exception as e:
+        metrics.inc("meduza_etcd_errors_total", error=type(e).__name__)
+        raise
+    finally:
+        metrics.observe("meduza_etcd_request_duration_seconds", time.monotonic() - start)
+
+
+def _etcd_call_with_failover(fn):
     _ensure_etcd()
+    client = etcd
     try:
         return fn()
     except grpc.RpcError as e:
         if e.code() == StatusCode.UNAUTHENTICATED:
             _reset_etcd()
             return fn()
-        raise
+        if not _is_failover_error(e):
+            raise
+        err: Exception = e
+    except (etcd3.exceptions.ConnectionFailedError, etcd3.exceptions.ConnectionTimeoutError) as e:
+        err = e
+    print(f"[etcd] {_endpoint_name(_etcd_endpoint)} failed: {err!r}; failing over", flush=True)
+    metrics.inc("meduza_etcd_failovers_total")
+    _reset_etcd(failed_client=client)
+    return fn()
 
 
 def load_prefix(prefix: str) -> Dict[str, str]:
+    if etcd_mirror.ready and etcd_mirror.covers(prefix):
+        return etcd_mirror.get_prefix(prefix)
     out: Dict[str, str] = {}
     for value, meta in _etcd_call(lambda: list(etcd.get_prefix(prefix))):
         key = getattr(meta, "key", None)
@@ -125,12 +365,85 @@ def load_all_nodes() -> Dict[str, str]:
 
 
 def load_key(key: str) -> str:
+    if etcd_mirror.ready and etcd_mirror.covers(key):
+        return etcd_mirror.get(key)
     value, _meta = _etcd_call(lambda: etcd.get(key))
     if value is None:
         return ""
     return value.decode("utf-8")
 
 
+# Ranges read by handle_commit(); fetched together in one transaction.
+SNAPSHOT_PREFIXES = ("/nodes/", "/global/", f"{ETCD_HOSTS_PREFIX}/")
+
+
+def _prefix_range_end(prefix: str) -> bytes:
+    raw = prefix.encode("utf-8")
+    return raw[:-1] + bytes([raw[-1] + 1])
+
+
+class ConfigSnapshot:
+    """Config ranges read at a single etcd revision."""
+
+    def __init__(self, ranges: Dict[str, Dict[str, str]], revision: int, mod_revision: int) -> None:
+        self.ranges = ranges
+        self.revision = revision
+        # Highest mod_revision of any key in the ranges. Together with the key
+        # count it changes whenever a key is added, updated or deleted.
+        self.mod_revision = mod_revision
+        self.key_count = sum(len(r) for r in ranges.values())
+
+    @property
+    def fingerprint(self) -> Tuple[int, int]:
+        return (self.mod_revision, self.key_count)
+
+    def prefix(self, prefix: str) -> Dict[str, str]:
+        if prefix in self.ranges:
+            return self.ranges[prefix]
+        for base, data in self.ranges.items():
+            if prefix.startswith(base):
+                return {k: v for k, v in data.items() if k.startswith(prefix)}
+        raise KeyError(f"prefix {prefix!r} is not part of the snapshot")
+
+
+def _read_ranges(prefixes: Tuple[str, ...]) -> Tuple[Dict[str, Dict[str, Tuple[str, int]]], int]:
+    """Read prefixes in one etcd transaction.
+
+    Returns ``{prefix: {key: (value, mod_revision)}}`` and the revision the read was served at.
+    """
+    def txn():
+        ops = [etcd.transactions.get(p, range_end=_prefix_range_end(p)) for p in prefixes]
+        return etcd.transaction(compare=[], success=ops, failure=[])
+
+    _ok, responses = _etcd_call(txn)
+    ranges: Dict[str, Dict[str, Tuple[str, int]]] = {}
+    revision = 0
+    for prefix, kvs in zip(prefixes, responses):
+        out: Dict[str, Tuple[str, int]] = {}
+        for value, meta in kvs:
+            out[meta.key.decode("utf-8")] = (value.decode("utf-8"), meta.mod_revision)
+            revision = max(revision, meta.response_header.revision)
+        ranges[prefix] = out
+    if revision == 0:
+        # All ranges empty: the txn header is not exposed, so ask for it separately.
+        revision = _etcd_call(lambda: etcd.get_response("/commit")).header.revision
+    return ranges, revision
+
+
+def load_snapshot(prefixes: Tuple[str, ...] = SNAPSHOT_PREFIXES, min_revision: int = 0) -> ConfigSnapshot:
+    """Read all prefixes at one revision.
+
+    Served from the local mirror when it has caught up to ``min_revision``;
+    otherwise read directly in one etcd transaction.
+    """
+    if etcd_mirror.ready and etcd_mirror.wait_for(min_revision, ETCD_MIRROR_WAIT_SECONDS):
+        return etcd_mirror.snapshot(prefixes)
+    raw, revision = _read_ranges(prefixes)
+    ranges = {p: {k: v for k, (v, _mod) in data.items()} for p, data in raw.items()}
+    mod_revision = max((mod for data in raw.values() for _v, mod in data.values()), default=0)
+    return ConfigSnapshot(ranges, revision, mod_revision)
+
+
 class Backoff:
     def __init__(self, base=1.0, cap=60.0):
         self.base = base
@@ -145,10 +458,142 @@ class Backoff:
         self.attempt = 0
 
 
+# ---------- etcd mirror ----------
+ETCD_MIRROR_ENABLE = os.environ.get("ETCD_MIRROR", "1").strip().lower() not in ("0", "false", "no")
+ETCD_MIRROR_WAIT_SECONDS = float(os.environ.get("ETCD_MIRROR_WAIT_SECONDS", "5"))
+
+
+class EtcdMirror:
+    """In-memory copy of the config prefixes, kept current by a revisioned watch.
+
+    One transaction loads every prefix at a single revision, then one watch
+    started at ``revision + 1`` applies puts/deletes without gaps. The watch
+    covers the contiguous range from ``/commit`` to the end of the last prefix
+    (``/updated/`` sorts after it, so our own status writes are not seen).
+    Reads are served from memory while ``ready`` is set; callers fall back to
+    direct gRPC reads before the first sync and while resyncing after a
+    compaction.
+    """
+
+    def __init__(self, prefixes: Tuple[str, ...]) -> None:
+        self.prefixes = prefixes
+        self._watch_key = min(prefixes + ("/commit",))
+        self._watch_end = max(_prefix_range_end(p) for p in prefixes)
+        self._cond = threading.Condition()
+        self._data: Dict[str, Tuple[str, int]] = {}
+        self._revision = 0
+        self._ready = False
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    @property
+    def revision(self) -> int:
+        with self._cond:
+            return self._revision
+
+    def covers(self, key_or_prefix: str) -> bool:
+        return any(key_or_prefix.startswith(p) for p in self.prefixes)
+
+    def get_prefix(self, prefix: str) -> Dict[str, str]:
+        with self._cond:
+            return {k: v for k, (v, _mod) in self._data.items() if k.startswith(prefix)}
+
+    def get(self, key: str) -> str:
+        with self._cond:
+            item = self._data.get(key)
+        return item[0] if item else ""
+
+    def snapshot(self, prefixes: Tuple[str, ...]) -> ConfigSnapshot:
+        ranges: Dict[str, Dict[str, str]] = {p: {} for p in prefixes}
+        mod_revision = 0
+        with self._cond:
+            for key, (value, mod) in self._data.items():
+                for p in prefixes:
+                    if key.startswith(p):
+                        ranges[p][key] = value
+                        mod_revision = max(mod_revision, mod)
+            return ConfigSnapshot(ranges, self._revision, mod_revision)
+
+    def wait_for(self, revision: int, timeout: float) -> bool:
+        """Block until the mirror has applied ``revision``; False on timeout or if not ready."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._ready and self._revision >= revision, timeout)
+
+    def _resync(self) -> None:
+        with self._cond:
+            self._ready = False
+        raw, revision = _read_ranges(self.prefixes)
+        data: Dict[str, Tuple[str, int]] = {}
+        for items in raw.values():
+            data.update(items)
+        with self._cond:
+            self._data = data
+            self._revision = revision
+            self._ready = True
+            self._cond.notify_all()
+        print(f"[mirror] synced {len(data)} key(s) at rev={revision}", flush=True)
+
+    def _apply(self, response: Any) -> None:
+        with self._cond:
+            for ev in response.events:
+                key = ev.key.decode("utf-8")
+                if not self.covers(key):
+                    continue
+                if isinstance(ev, etcd3.events.DeleteEvent):
+                    self._data.pop(key, None)
+                else:
+                    self._data[key] = (ev.value.decode("utf-8"), ev.mod_revision)
+            self._revision = max(self._revision, response.header.revision)
+            self._cond.notify_all()
+
+    def run(self) -> None:
+        backoff = Backoff()
+        resync = True
+        while True:
+            cancel = None
+            try:
+                if resync:
+                    self._resync()
+                    resync = False
+                start = self.revision + 1
+                responses, cancel = _etcd_call(lambda: etcd.watch_response(
+                    self._watch_key,
+                    range_end=self._watch_end,
+                    start_revision=start,
+                    progress_notify=True,
+                ))
+                backoff.reset()
+                for response in responses:
+                    self._apply(response)
+            except etcd3.exceptions.RevisionCompactedError as e:
+                print(f"[mirror] revision compacted ({e}); resyncing", flush=True)
+                resync = True
+            except Exception as e:
+                t = backoff.next_sleep()
+                print(f"[mirror] watch error: {e}; resume from rev={self.revision + 1} in {t:.1f}s", flush=True)
+                time.sleep(t)
+            finally:
+                try:
+                    if cancel:
+                        cancel()
+                except Exception:
+                    pass
+
+
+etcd_mirror = EtcdMirror(SNAPSHOT_PREFIXES)
+
+
 # state
 last_hash: Dict[str, str] = {}
 tproxy_enabled = False
 reconcile_force = False
+_last_snapshot_fingerprint: Optional[Tuple[int, int]] = None
+# latency_costs() seen by the last reconcile; a change re-renders FRR on an unchanged snapshot
+_last_latency_costs: Dict[str, int] = {}
+# mod_revision of the newest /commit seen by watch_loop
+_commit_revision = 0
 
 # Clash refresh state
 _clash_refresh_lock = threading.Lock()
@@ -180,6 +625,11 @@ _proxy_ips_enabled = False
 # reconcile lock
 _reconcile_lock = threading.Lock()
 
+# reconcile scheduler: watch/periodic/etc. bump the generation, one worker consumes it
+_reconcile_cond = threading.Condition()
+_reconcile_generation = 0
+_reconcile_reasons: Dict[str, int] = {}
+
 # online lease
 _lease_lock = threading.Lock()
 _online_lease: Optional[Any] = None
@@ -265,6 +715,7 @@ def reload_easytier(node: Dict[str, str], global_cfg: Dict[str, str]) -> None:
 
 # ---------- Tinc (switch mode) ----------
 def _write_text(path: str, text: str, mode: Optional[int] = None) -> None:
+    _journal_note_write(path)
     os.makedirs(os.path.dirname(path), exist_ok=True)
     with open(path, "w", encoding="utf-8") as f:
         f.write(text)
@@ -280,6 +731,7 @@ def _read_text(path: str) -> str:
 def _write_if_changed(path: str, text: str, mode: Optional[int] = None) -> bool:
     try:
         if _read_text(path) == text:
+            _journal_note_write(path)
             return False
     except FileNotFoundError:
         pass
@@ -288,6 +740,166 @@ def _write_if_changed(path: str, text: str, mode: Optional[int] = None) -> bool:
 
 
 def _run_generator(name: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    start = time.monotonic()
+    try:
+        key = _generator_cache_key(name, payload)
+        if key is not None:
+            cached = _generator_cache_get(key)
+            if cached is not None:
+                metrics.inc("meduza_generator_cache_total", generator=name, result="hit")
+                return cached
+            metrics.inc("meduza_generator_cache_total", generator=name, result="miss")
+        module = _generator_module(name) if GENERATOR_MODE != "subprocess" else None
+        if module is None:
+            out = _run_generator_process(name, payload)
+        else:
+            out = _run_generator_inprocess(name, module, payload)
+        if key is not None:
+            _generator_cache_put(key, out)
+        return out
+    except Exception:
+        metrics.inc("meduza_generator_errors_total", generator=name)
+        raise
+    finally:
+        metrics.observe("meduza_generator_duration_seconds", time.monotonic() - start, generator=name)
+
+
+_generator_lock = threading.Lock()
+# name -> imported module, or None when the import failed (use the subprocess path)
+_generator_modules: Dict[str, Any] = {}
+
+
+def _generator_module(name: str) -> Optional[Any]:
+    with _generator_lock:
+        if name in _generator_modules:
+            return _generator_modules[name]
+        if GEN_DIR not in sys.path:
+            sys.path.insert(0, GEN_DIR)
+        try:
+            module = importlib.import_module(name)
+            if not callable(getattr(module, "generate", None)):
+                raise ImportError(f"{name} has no generate(payload)")
+        except Exception as e:
+            print(f"[generator] {name} in-process import failed: {e!r}; using subprocess", flush=True)
+            module = None
+        _generator_modules[name] = module
+        return module
+
+
+def _run_generator_inprocess(name: str, module: Any, payload: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        out = module.generate(payload)
+    except Exception as e:
+        raise RuntimeError(f"generator {name} failed: {e}") from e
+    if not isinstance(out, dict):
+        raise RuntimeError(f"generator {name} returned {type(out).__name__}, expected dict")
+    return out
+
+
+# Generator -> payload sections it reads, each mapped to the key tails it reads
+# (after "/nodes/<id>/" or "/global/"); None means the whole section. Sections
+# not listed are ignored. Generators missing here (gen_clash fetches the
+# subscription over HTTP) are never cached.
+GENERATOR_CACHE_INPUTS: Dict[str, Dict[str, Optional[Tuple[str, ...]]]] = {
+    "gen_easytier": {"node": ("easytier/",), "global": ("easytier/",)},
+    "gen_tinc": {"node": ("tinc/",), "global": ("tinc/",), "all_nodes": ("tinc/",)},
+    "gen_openvpn": {"node": ("openvpn/",)},
+    "gen_wireguard": {"node": ("wireguard/",)},
+    "gen_mosdns": {"node": ("mosdns/",), "global": ("mosdns/",)},
+    "gen_access": {"node": None, "global": ("access/", "bgp/"), "all_nodes": None},
+    "gen_frr": {"node": None, "global": None, "all_nodes": None, "latency": None},
+}
+
+_generator_cache_lock = threading.Lock()
+_generator_cache: "OrderedDict[str, str]" = OrderedDict()
+# name -> sha256 of the generator source (and common.py), so code updates invalidate entries
+_generator_source_hashes: Dict[str, str] = {}
+
+
+def _key_tail(key: str) -> str:
+    if key.startswith("/nodes/"):
+        return key[len("/nodes/"):].split("/", 1)[-1]
+    if key.startswith("/global/"):
+        return key[len("/global/"):]
+    return key
+
+
+def _generator_source_hash(name: str) -> str:
+    digest = _generator_source_hashes.get(name)
+    if digest is None:
+        h = hashlib.sha256()
+        for path in (f"{GEN_DIR}/{name}.py", f"{GEN_DIR}/common.py"):
+            h.update(_file_sha256(path).encode("ascii"))
+        digest = _generator_source_hashes[name] = h.hexdigest()
+    return digest
+
+
+def _generator_cache_key(name: str, payload: Dict[str, Any]) -> Optional[str]:
+    inputs = GENERATOR_CACHE_INPUTS.get(name)
+    if inputs is None or GENERATOR_CACHE_SIZE <= 0:
+        return None
+    material: Dict[str, Any] = {"node_id": payload.get("node_id")}
+    for section, tails in inputs.items():
+        data = payload.get(section) or {}
+        if tails is not None:
+            data = {k: v for k, v in data.items() if _key_tail(k).startswith(tails)}
+        material[section] = data
+    h = hashlib.sha256()
+    h.update(f"{name}\0{_generator_source_hash(name)}\0".encode("utf-8"))
+    h.update(json.dumps(material, sort_keys=True, ensure_ascii=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _generator_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    with _generator_cache_lock:
+        text = _generator_cache.get(key)
+        if text is None:
+            return None
+        _generator_cache.move_to_end(key)
+    # Decoding gives every caller its own copy of the output.
+    return json.loads(text)
+
+
+def _generator_cache_put(key: str, out: Dict[str, Any]) -> None:
+    text = json.dumps(out, ensure_ascii=True)
+    with _generator_cache_lock:
+        _generator_cache[key] = text
+        _generator_cache.move_to_end(key)
+        while len(_generator_cache) > GENERATOR_CACHE_SIZE:
+            _generator_cache.popitem(last=False)
+        entries = list(_generator_cache.items())
+    try:
+        os.makedirs(os.path.dirname(GENERATOR_CACHE_PATH), mode=0o700, exist_ok=True)
+        tmp = GENERATOR_CACHE_PATH + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"node_id": NODE_ID, "entries": entries}, f)
+        os.replace(tmp, GENERATOR_CACHE_PATH)
+    except Exception as e:
+        print(f"[generator] failed to save cache {GENERATOR_CACHE_PATH}: {e}", flush=True)
+
+
+def load_generator_cache() -> None:
+    if GENERATOR_CACHE_SIZE <= 0:
+        return
+    try:
+        with open(GENERATOR_CACHE_PATH, "r", encoding="utf-8") as f:
+            doc = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"[generator] ignoring unreadable cache {GENERATOR_CACHE_PATH}: {e}", flush=True)
+        return
+    if doc.get("node_id") != NODE_ID:
+        return
+    with _generator_cache_lock:
+        for key, text in doc.get("entries", [])[-GENERATOR_CACHE_SIZE:]:
+            _generator_cache[key] = text
+        count = len(_generator_cache)
+    print(f"[generator] restored {count} cached output(s)", flush=True)
+
+
+def _run_generator_process(name: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     cmd = ["python3", f"{GEN_DIR}/{name}.py"]
     cp = subprocess.run(
         cmd,
@@ -403,6 +1015,16 @@ def _supervisor_is_available() -> bool:
         return False
 
 
+# reread/update act on every program's config; don't let parallel domains interleave them
+_supervisor_conf_lock = threading.Lock()
+
+
+def _supervisor_update() -> None:
+    with _supervisor_conf_lock:
+        _supervisorctl(["reread"])
+        _supervisorctl(["update"])
+
+
 def _supervisor_start(name: str) -> None:
     _supervisorctl(["start", name])
 
@@ -523,8 +1145,7 @@ def reload_openvpn(node: Dict[str, str]) -> Tuple[bool, List[str]]:
             except Exception:
                 pass
 
-    _supervisorctl(["reread"])
-    _supervisorctl(["update"])
+    _supervisor_update()
 
     for name in enabled:
         _supervisor_restart(f"openvpn-{name}")
@@ -568,8 +1189,7 @@ def reload_access_openvpn(node: Dict[str, str], global_cfg: Dict[str, str], all_
             "/etc/openvpn/generated/access.ldapca",
         ]:
             changed = _remove_file_if_exists(extra) or changed
-        _supervisorctl(["reread"])
-        _supervisorctl(["update"])
+        _supervisor_update()
         return changed
 
     inst = out["instance"]
@@ -588,8 +1208,7 @@ def reload_access_openvpn(node: Dict[str, str], global_cfg: Dict[str, str], all_
             _ovpn_cfg_names.append("access")
             _ovpn_cfg_names.sort()
 
-    _supervisorctl(["reread"])
-    _supervisorctl(["update"])
+    _supervisor_update()
     _supervisor_restart("openvpn-access")
     _write_openvpn_status("access", "connecting")
     return changed
@@ -679,8 +1298,7 @@ def reload_wireguard(node: Dict[str, str]) -> Tuple[bool, List[str]]:
             except Exception:
                 pass
 
-    _supervisorctl(["reread"])
-    _supervisorctl(["update"])
+    _supervisor_update()
 
     for name in enabled:
         _supervisor_restart(f"wireguard-{name}")
@@ -701,6 +1319,144 @@ def wireguard_status_loop():
             _write_wireguard_status(name, status)
 
 
+# ---------- Tunnel latency probes ----------
+# OpenVPN/WireGuard BGP transports are pinged over their device every
+# LATENCY_PROBE_INTERVAL seconds (0 disables). RTT and loss are smoothed; the
+# loss-weighted cost handed to gen_frr only moves once it differs from the
+# current one by LATENCY_HYSTERESIS_MS and LATENCY_HOLDDOWN seconds have passed.
+LATENCY_PROBE_INTERVAL = int(os.environ.get("LATENCY_PROBE_INTERVAL", "10"))
+LATENCY_PROBE_COUNT = int(os.environ.get("LATENCY_PROBE_COUNT", "5"))
+LATENCY_HYSTERESIS_MS = int(os.environ.get("LATENCY_HYSTERESIS_MS", "20"))
+LATENCY_HOLDDOWN = int(os.environ.get("LATENCY_HOLDDOWN", "60"))
+LATENCY_REFRESH = int(os.environ.get("LATENCY_REFRESH", "300"))
+LATENCY_LOSS_PENALTY_MS = 10  # cost added per % of lost probes
+_LATENCY_EWMA_ALPHA = 0.3
+
+_PING_LOSS_RE = re.compile(r"([\d.]+)% packet loss")
+_PING_RTT_RE = re.compile(r"= [\d.]+/([\d.]+)/")
+
+_latency_lock = threading.Lock()
+_latency_targets: Dict[str, Tuple[str, str]] = {}  # "<kind>/<name>" -> (dev, peer_ip)
+_latency_smoothed: Dict[str, Tuple[float, float]] = {}  # key -> (rtt ms, loss %)
+_latency_costs: Dict[str, int] = {}  # key -> cost in ms fed to gen_frr
+_latency_changed_at: Dict[str, float] = {}
+
+
+def set_latency_targets(targets: Dict[str, Dict[str, str]]) -> None:
+    with _latency_lock:
+        _latency_targets.clear()
+        _latency_targets.update({k: (t["dev"], t["peer_ip"]) for k, t in targets.items()})
+        for state in (_latency_smoothed, _latency_costs, _latency_changed_at):
+            for key in [k for k in state if k not in _latency_targets]:
+                del state[key]
+
+
+def latency_costs() -> Dict[str, int]:
+    with _latency_lock:
+        return dict(_latency_costs)
+
+
+def latency_smoothed() -> Dict[str, List[float]]:
+    with _latency_lock:
+        return {k: list(v) for k, v in _latency_smoothed.items()}
+
+
+def restore_latency(costs: Dict[str, int], smoothed: Dict[str, List[float]]) -> None:
+    """Seed the probe state from the journal, so a restart renders the costs FRR already has.
+
+    The hold-down restarts now: probes only move a restored cost once it has passed.
+    """
+    now = time.monotonic()
+    with _latency_lock:
+        for key, (rtt, loss) in smoothed.items():
+            if key in _latency_targets:
+                _latency_smoothed[key] = (float(rtt), float(loss))
+        for key, cost in costs.items():
+            if key in _latency_targets:
+                _latency_costs[key] = int(cost)
+                _latency_changed_at[key] = now
+
+
+def _probe_latency(dev: str, peer_ip: str) -> Tuple[Optional[float], float]:
+    """(average RTT in ms or None, loss %) of a short ping burst through ``dev``."""
+    cp = subprocess.run(
+        ["ping", "-n", "-q", "-c", str(LATENCY_PROBE_COUNT), "-i", "0.2", "-W", "1", "-I", dev, peer_ip],
+        capture_output=True,
+        text=True,
+    )
+    loss = _PING_LOSS_RE.search(cp.stdout)
+    rtt = _PING_RTT_RE.search(cp.stdout)
+    return (float(rtt.group(1)) if rtt else None), (float(loss.group(1)) if loss else 100.0)
+
+
+def _latency_update(key: str, rtt: Optional[float], loss: float, now: float) -> bool:
+    """Fold one probe into the smoothed values; True when the cost for gen_frr changed."""
+    with _latency_lock:
+        prev = _latency_smoothed.get(key)
+        if prev is not None:
+            # A burst with every probe lost keeps the last RTT; the loss carries the penalty.
+            rtt = prev[0] + _LATENCY_EWMA_ALPHA * ((prev[0] if rtt is None else rtt) - prev[0])
+            loss = prev[1] + _LATENCY_EWMA_ALPHA * (loss - prev[1])
+        elif rtt is None:
+            return False
+        _latency_smoothed[key] = (rtt, loss)
+        cost = int(rtt + loss * LATENCY_LOSS_PENALTY_MS)
+        current = _latency_costs.get(key)
+        if current is not None and (
+            abs(cost - current) < LATENCY_HYSTERESIS_MS or now - _latency_changed_at.get(key, 0.0) < LATENCY_HOLDDOWN
+        ):
+            return False
+        _latency_costs[key] = cost
+        _latency_changed_at[key] = now
+        return True
+
+
+def latency_probe_loop() -> None:
+    # key -> (cost or "down", monotonic time written); a latency key is rewritten
+    # when its cost changes, and at least every LATENCY_REFRESH seconds
+    published: Dict[str, Tuple[str, float]] = {}
+    while True:
+        time.sleep(max(3, LATENCY_PROBE_INTERVAL))
+        with _latency_lock:
+            targets = dict(_latency_targets)
+        for key in [k for k in published if k not in targets]:
+            try:
+                _etcd_call(lambda: etcd.delete(f"{UPDATE_BASE}/{key}/latency"))
+                del published[key]
+            except Exception as e:
+                print(f"[latency] failed to delete {key}: {e}", flush=True)
+        moved: List[str] = []
+        for key, (dev, peer_ip) in sorted(targets.items()):
+            try:
+                rtt, loss = _probe_latency(dev, peer_ip)
+            except Exception as e:
+                print(f"[latency] probe {key} failed: {e}", flush=True)
+                continue
+            now = time.monotonic()
+            if _latency_update(key, rtt, loss, now):
+                moved.append(key)
+            with _latency_lock:
+                smoothed = _latency_smoothed.get(key)
+                cost = _latency_costs.get(key)
+            if smoothed is None:
+                state, value = "down", f"down 100 {now_utc_iso()}"
+            else:
+                metrics.set("meduza_tunnel_rtt_seconds", smoothed[0] / 1000.0, transport=key)
+                metrics.set("meduza_tunnel_loss_ratio", smoothed[1] / 100.0, transport=key)
+                state, value = str(cost), f"{smoothed[0]:.1f} {smoothed[1]:.0f} {now_utc_iso()}"
+            prev = published.get(key)
+            if prev is not None and prev[0] == state and now - prev[1] < LATENCY_REFRESH:
+                continue
+            try:
+                _etcd_call(lambda: etcd.put(f"{UPDATE_BASE}/{key}/latency", value))
+                published[key] = (state, now)
+            except Exception as e:
+                print(f"[latency] failed to write {key}: {e}", flush=True)
+        if moved:
+            print(f"[latency] cost changed: {', '.join(moved)}", flush=True)
+            request_reconcile("latency")
+
+
 def monitor_children_loop():
     backoffs: Dict[str, Backoff] = {}
     next_time: Dict[str, float] = {}
@@ -1001,17 +1757,487 @@ def reload_frr_smooth(conf_text: str) -> None:
     run("vtysh -f /etc/frr/frr.conf")
 
 
+# ---------- FRR delta apply ----------
+# "delta" pushes only changed stanzas of gen_frr's frr_model through one vtysh
+# session; "reload" always uses reload_frr_smooth().
+FRR_APPLY_MODE = os.environ.get("FRR_APPLY", "delta").strip().lower()
+
+# Statements FRR cannot change at runtime; any difference forces a full reload.
+_FRR_STATIC_PREFIXES = ("frr defaults ", "service ")
+# BGP exchanges these capabilities only when a session is established
+_FRR_BGP_CAPABILITY_PREFIXES = ("bgp graceful-restart", "bgp long-lived-graceful-restart")
+
+
+def _frr_startup_lines(model: Dict[str, Any]) -> List[str]:
+    """Statements a running daemon does not act on: startup settings and BGP capabilities."""
+    out = [l for l in model["lines"] if l.startswith(_FRR_STATIC_PREFIXES)]
+    for block in model["blocks"]:
+        if block["header"].startswith("router bgp "):
+            out += [l for l in block["lines"] if l.startswith(_FRR_BGP_CAPABILITY_PREFIXES)]
+    return out
+
+_PREFIX_LIST_SEQ_RE = re.compile(r"^ip prefix-list (\S+) seq (\d+) ")
+
+# Single-valued settings: a new value overwrites the old one in place, so the
+# old line is not negated first (that would briefly leave e.g. a neighbor
+# without its route-map). Returns the setting's key, or None.
+_FRR_SETTING_RE = re.compile(
+    r"^(neighbor \S+ route-map) \S+ (in|out)$"
+    r"|^(neighbor \S+ (?:description|update-source|weight|bfd profile|maximum-prefix)) "
+    r"|^(ip router-id|bgp router-id|ospf router-id|bgp cluster-id|bgp listen limit|maximum-paths"
+    r"|ip ospf area|set local-preference|set tag|match tag"
+    r"|detect-multiplier|receive-interval|transmit-interval"
+    r"|bgp dampening|timers throttle spf|timers throttle lsa all|timers lsa min-arrival"
+    r"|bgp graceful-restart restart-time|bgp graceful-restart stalepath-time"
+    r"|bgp long-lived-graceful-restart stale-time|update-delay|graceful-restart grace-period) "
+)
+
+
+def _frr_setting_key(line: str) -> Optional[str]:
+    m = _FRR_SETTING_RE.match(line)
+    if not m:
+        return None
+    if m.group(1):
+        return f"{m.group(1)} {m.group(2)}"
+    return m.group(3) or m.group(4)
+
+# frr_model last applied to the running daemons (None: unknown, next apply is a full reload)
+_frr_applied_model: Optional[Dict[str, Any]] = None
+
+
+def _frr_block_delta(old: Dict[str, Any], new: Dict[str, Any], created: bool) -> List[str]:
+    """Commands turning block ``old`` into ``new`` inside the block's context."""
+    # "no neighbor X" drops all of X's config, so a neighbor whose remote-as
+    # changed or went away is removed once and its new lines re-added in full.
+    new_lines = set(new["lines"])
+    dropped = {
+        line.split()[1] for line in old["lines"]
+        if line.startswith("neighbor ") and " remote-as " in line and line not in new_lines
+    }
+
+    def of_dropped(line: str) -> bool:
+        if line.startswith("bgp listen range "):
+            return line.split()[-1] in dropped
+        return line.startswith("neighbor ") and line.split()[1] in dropped
+
+    def diff(old_lines: List[str], cur_lines: List[str]) -> List[str]:
+        cur, prev = set(cur_lines), set(old_lines)
+        overwritten = {_frr_setting_key(line) for line in cur_lines} - {None}
+        out = [
+            f"no {line}" for line in old_lines
+            if line not in cur and not of_dropped(line) and _frr_setting_key(line) not in overwritten
+        ]
+        out += [line for line in cur_lines if line not in prev or of_dropped(line)]
+        return out
+
+    # A listen range goes before the peer-group it accepts peers into
+    body = [f"no {line}" for line in old["lines"] if line.startswith("bgp listen range ") and of_dropped(line)]
+    body += [f"no neighbor {peer}" for peer in sorted(dropped)]
+    body += diff(old["lines"], new["lines"])
+    old_sections = {sec["header"]: sec["lines"] for sec in old["sections"]}
+    new_sections = {sec["header"]: sec["lines"] for sec in new["sections"]}
+    for header in new_sections:
+        sub = diff(old_sections.get(header, []), new_sections[header])
+        if sub:
+            end = "exit-address-family" if header.startswith("address-family ") else "exit"
+            body += [header] + sub + [end]
+    body += [f"no {header}" for header in old_sections if header not in new_sections]
+    if not body and not created:
+        return []
+    return [new["header"]] + body + ["exit"]
+
+
+def _frr_delta(old: Dict[str, Any], new: Dict[str, Any]) -> Optional[List[str]]:
+    """vtysh configure commands turning model ``old`` into ``new``, or None if a full reload is needed."""
+    if _frr_startup_lines(old) != _frr_startup_lines(new):
+        return None
+    old_lines, new_lines = set(old["lines"]), set(new["lines"])
+    old_blocks = {b["header"]: b for b in old["blocks"]}
+    new_blocks = {b["header"]: b for b in new["blocks"]}
+    empty = {"lines": [], "sections": []}
+
+    # A prefix-list entry whose seq is not reused is removed only after the new
+    # entries are in, so the list never has a gap; a reused seq is freed first.
+    def pl_slot(line: str) -> Optional[Tuple[str, str]]:
+        m = _PREFIX_LIST_SEQ_RE.match(line)
+        return (m.group(1), m.group(2)) if m else None
+
+    added = [line for line in new["lines"] if line not in old_lines]
+    added_slots = {pl_slot(line) for line in added} - {None}
+    overwritten = {_frr_setting_key(line) for line in added} - {None}
+    removed = [
+        line for line in old["lines"]
+        if line not in new_lines and not line.startswith("hostname ") and _frr_setting_key(line) not in overwritten
+    ]
+    deferred = [line for line in removed if pl_slot(line) is not None and pl_slot(line) not in added_slots]
+
+    cmds = [f"no {line}" for line in removed if line not in deferred]
+    for header, block in old_blocks.items():
+        if header in new_blocks:
+            continue
+        if header.startswith("interface "):
+            # Interfaces exist in the kernel; only their FRR settings are removed.
+            cmds += _frr_block_delta(block, dict(empty, header=header), created=False)
+        elif header == "bfd" or header.startswith("route-map "):
+            # Neighbors drop their bfd profiles / switch route-maps in the router
+            # block first; a neighbor whose route-map is missing denies everything.
+            deferred.append(header)
+        else:
+            cmds.append(f"no {header}")
+    cmds += added
+    for header, block in new_blocks.items():
+        cmds += _frr_block_delta(old_blocks.get(header, empty), block, created=header not in old_blocks)
+    cmds += [f"no {line}" for line in deferred]
+    return cmds
+
+
+def _vtysh_configure(cmds: List[str]) -> None:
+    args = ["vtysh", "-c", "configure terminal"]
+    for cmd in cmds:
+        args += ["-c", cmd]
+    args += ["-c", "end"]
+    cp = subprocess.run(args, capture_output=True, text=True)
+    if cp.returncode != 0:
+        raise RuntimeError(f"vtysh exit {cp.returncode}: {(cp.stderr or cp.stdout).strip()}")
+
+
+def _frr_graceful_restart(model: Dict[str, Any]) -> Tuple[bool, bool]:
+    """(bgp, ospf) graceful restart configured in a frr_model."""
+    blocks = {b["header"].split()[1]: b for b in model["blocks"] if b["header"].startswith("router ")}
+    bgp = "bgp graceful-restart" in blocks.get("bgp", {}).get("lines", [])
+    ospf = any(l.startswith("graceful-restart grace-period ") for l in blocks.get("ospf", {}).get("lines", []))
+    return bgp, ospf
+
+
+def restart_frr_graceful(conf_text: str, running: Dict[str, Any]) -> None:
+    """Restart the FRR daemons (running ``running``) without dropping forwarding.
+
+    Used for statements FRR only reads at startup, and for graceful-restart
+    capabilities, which BGP only sends when a session comes up (the restart
+    re-establishes every session with the new ones). BGP peers retain our routes
+    through graceful restart, OSPF neighbors act as helpers after the grace
+    LSA, and zebra (-K/-r in frr/daemons) keeps the kernel routes until the
+    daemons have re-installed them.
+    """
+    _write_if_changed("/etc/frr/frr.conf", conf_text)
+    if _frr_graceful_restart(running)[1]:
+        run("vtysh -c 'graceful-restart prepare ip ospf'")
+    run("/usr/lib/frr/frrinit.sh restart")
+
+
+def apply_frr(conf_text: str, model: Optional[Dict[str, Any]], full: bool = False) -> None:
+    """Apply a generated FRR config, as a delta against the last applied model when possible."""
+    global _frr_applied_model
+    old = _frr_applied_model
+    if not full and FRR_APPLY_MODE == "delta" and model and old:
+        cmds = _frr_delta(old, model)
+        if cmds is None and any(_frr_graceful_restart(old)):
+            # Startup-only statements or BGP capabilities changed and the running
+            # daemons can restart gracefully: restart instead of a reload that ignores them.
+            try:
+                _frr_applied_model = None
+                restart_frr_graceful(conf_text, old)
+                _frr_applied_model = model
+                metrics.inc("meduza_frr_apply_total", mode="restart")
+                print("[frr] restarted gracefully for startup-only changes", flush=True)
+                return
+            except Exception as e:
+                print(f"[frr] graceful restart failed, falling back to full reload: {e}", flush=True)
+        elif cmds is None and _frr_startup_lines(old) != _frr_startup_lines(model):
+            print(
+                "[frr] startup-only statements changed without graceful restart running; "
+                "new BGP capabilities take effect as sessions re-establish",
+                flush=True,
+            )
+        if cmds is not None:
+            try:
+                if cmds:
+                    _vtysh_configure(cmds)
+                _write_if_changed("/etc/frr/frr.conf", conf_text)
+                _frr_applied_model = model
+                metrics.inc("meduza_frr_apply_total", mode="delta")
+                print(f"[frr] applied {len(cmds)} delta command(s)", flush=True)
+                return
+            except Exception as e:
+                print(f"[frr] delta apply failed, falling back to full reload: {e}", flush=True)
+    _frr_applied_model = None
+    reload_frr_smooth(conf_text)
+    _frr_applied_model = model
+    metrics.inc("meduza_frr_apply_total", mode="full")
+
+
+# ---------- FRR session status ----------
+# Polls bgpd/ospfd/zebra every FRR_STATUS_INTERVAL seconds (0 disables) and
+# publishes peer state, prefix counts and RIB size under /updated/<NODE_ID>/frr/
+# and to the metrics endpoint. Keys are rewritten when their content changes,
+# and at least every FRR_STATUS_REFRESH seconds.
+FRR_STATUS_INTERVAL = int(os.environ.get("FRR_STATUS_INTERVAL", "10"))
+FRR_STATUS_REFRESH = int(os.environ.get("FRR_STATUS_REFRESH", "300"))
+FRR_CONVERGE_TIMEOUT = int(os.environ.get("FRR_CONVERGE_TIMEOUT", "300"))
+FRR_STATUS_BASE = f"{UPDATE_BASE}/frr"
+
+_frr_status_lock = threading.Lock()
+# monotonic time of the last FRR apply whose convergence is still being measured
+_frr_converge_start: Optional[float] = None
+
+
+def frr_status_applied() -> None:
+    """Start measuring convergence for a config just applied."""
+    global _frr_converge_start
+    with _frr_status_lock:
+        _frr_converge_start = time.monotonic()
+
+
+def _vtysh_json(command: str) -> Optional[Any]:
+    """Output of a vtysh "... json" command, or None if the daemon does not answer."""
+    cp = subprocess.run(["vtysh", "-c", command], capture_output=True, text=True)
+    if cp.returncode != 0:
+        # bgpd/ospfd not running or not configured
+        return None
+    try:
+        return json.loads(cp.stdout or "{}")
+    except ValueError:
+        return None
+
+
+def _bgp_peer_state(detail: str) -> str:
+    detail = detail.lower()
+    if detail in ("established", "ok"):
+        return "up"
+    if "idle" in detail or "shutdown" in detail or "deleted" in detail:
+        return "down"
+    return "connecting"
+
+
+def _ospf_peer_state(detail: str) -> str:
+    detail = detail.lower()
+    if detail.startswith("full"):
+        return "up"
+    if detail.startswith(("down", "attempt")):
+        return "down"
+    return "connecting"
+
+
+def _frr_bgp_peers(summary: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Peers of "show bgp summary json" (one section per address family)."""
+    out: Dict[str, Dict[str, Any]] = {}
+    for af in summary.values():
+        if not isinstance(af, dict):
+            continue
+        for peer, data in (af.get("peers") or {}).items():
+            detail = str(data.get("state") or data.get("peerState") or "Unknown")
+            out[peer] = {
+                "state": _bgp_peer_state(detail),
+                "detail": detail,
+                "remote_as": data.get("remoteAs"),
+                "description": data.get("desc", ""),
+                "uptime": int(data.get("peerUptimeMsec", 0)) / 1000.0,
+                "prefixes_received": int(data.get("pfxRcd", 0) or 0),
+                "prefixes_sent": int(data.get("pfxSnt", 0) or 0),
+                "dropped": int(data.get("connectionsDropped", 0) or 0),
+            }
+    return out
+
+
+def _frr_ospf_peers(data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Neighbors of "show ip ospf neighbor json", keyed by router-id."""
+    out: Dict[str, Dict[str, Any]] = {}
+    for router_id, entries in (data.get("neighbors") or {}).items():
+        for entry in entries if isinstance(entries, list) else [entries]:
+            detail = str(entry.get("nbrState") or entry.get("state") or "Unknown")
+            out[router_id] = {
+                "state": _ospf_peer_state(detail),
+                "detail": detail,
+                "interface": entry.get("ifaceName", ""),
+            }
+    return out
+
+
+class FrrStatusExporter:
+    """State of the FRR status poller between rounds."""
+
+    def __init__(self) -> None:
+        # etcd key -> (value without timestamp, monotonic time written)
+        self.published: Dict[str, Tuple[str, float]] = {}
+        # "<protocol>/<peer>" -> last state / epoch the BGP session came up
+        self.states: Dict[str, str] = {}
+        self.since: Dict[str, float] = {}
+
+    def put(self, key: str, value: str, stamped: bool = False) -> None:
+        now = time.monotonic()
+        prev = self.published.get(key)
+        if prev is not None and prev[0] == value and now - prev[1] < FRR_STATUS_REFRESH:
+            return
+        text = f"{value} {now_utc_iso()}" if stamped else value
+        _etcd_call(lambda: etcd.put(key, text))
+        self.published[key] = (value, now)
+
+    def prune(self, keep: Set[str]) -> None:
+        for key in [k for k in self.published if k not in keep]:
+            _etcd_call(lambda: etcd.delete(key))
+            del self.published[key]
+
+    def poll(self) -> None:
+        keep: Set[str] = {f"{FRR_STATUS_BASE}/convergence"}
+        route_summary = _vtysh_json("show ip route summary json")
+        frr_up = route_summary is not None
+        metrics.set("meduza_frr_up", 1 if frr_up else 0)
+        key = f"{FRR_STATUS_BASE}/default/status"
+        self.put(key, "up" if frr_up else "down", stamped=True)
+        keep.add(key)
+        if not frr_up:
+            # Peer keys stay as last seen until FRR answers again.
+            return
+
+        for route in route_summary.get("routes", []):
+            metrics.set("meduza_frr_rib_routes", route.get("rib", 0), protocol=str(route.get("type", "")))
+        metrics.set("meduza_frr_fib_routes", route_summary.get("routesTotalFib", 0))
+        key = f"{FRR_STATUS_BASE}/rib"
+        self.put(key, json.dumps({
+            "routes": route_summary.get("routesTotal", 0),
+            "fib": route_summary.get("routesTotalFib", 0),
+            "by_protocol": {str(r.get("type", "")): r.get("rib", 0) for r in route_summary.get("routes", [])},
+        }, sort_keys=True))
+        keep.add(key)
+
+        peers = {("bgp", p): v for p, v in _frr_bgp_peers(_vtysh_json("show bgp summary json") or {}).items()}
+        peers.update(
+            {("ospf", p): v for p, v in _frr_ospf_peers(_vtysh_json("show ip ospf neighbor json") or {}).items()}
+        )
+        for (protocol, peer), info in sorted(peers.items()):
+            name = f"{protocol}/{peer}"
+            state = info["state"]
+            if self.states.get(name) != state:
+                if name in self.states:
+                    print(f"[frr-status] {name}: {self.states[name]} -> {state} ({info['detail']})", flush=True)
+                metrics.inc("meduza_frr_peer_transitions_total", protocol=protocol, peer=peer, state=state)
+                self.states[name] = state
+            metrics.set("meduza_frr_peer_up", 1 if state == "up" else 0, protocol=protocol, peer=peer)
+            key = f"{FRR_STATUS_BASE}/{name}/status"
+            self.put(key, state, stamped=True)
+            keep.add(key)
+            if protocol != "bgp":
+                continue
+            metrics.set("meduza_frr_bgp_prefixes_received", info["prefixes_received"], peer=peer)
+            metrics.set("meduza_frr_bgp_prefixes_sent", info["prefixes_sent"], peer=peer)
+            metrics.set("meduza_frr_bgp_connections_dropped", info["dropped"], peer=peer)
+            if state == "up":
+                # Uptime is turned into a start time so the key only changes on a new session.
+                since = time.time() - info["uptime"]
+                if abs(self.since.get(name, 0.0) - since) > 5:
+                    self.since[name] = since
+            else:
+                self.since.pop(name, None)
+            key = f"{FRR_STATUS_BASE}/{name}/detail"
+            self.put(key, json.dumps({
+                "state": info["detail"],
+                "remote_as": info["remote_as"],
+                "description": info["description"],
+                "established_at": (
+                    datetime.fromtimestamp(self.since[name], timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+0000")
+                    if name in self.since else ""
+                ),
+                "prefixes_received": info["prefixes_received"],
+                "prefixes_sent": info["prefixes_sent"],
+                "connections_dropped": info["dropped"],
+            }, sort_keys=True))
+            keep.add(key)
+
+        gone = [name for name in self.states if tuple(name.split("/", 1)) not in peers]
+        for name in gone:
+            protocol, peer = name.split("/", 1)
+            del self.states[name]
+            self.since.pop(name, None)
+            metrics.remove("meduza_frr_peer_up", protocol=protocol, peer=peer)
+            for metric in ("received", "sent"):
+                metrics.remove(f"meduza_frr_bgp_prefixes_{metric}", peer=peer)
+            metrics.remove("meduza_frr_bgp_connections_dropped", peer=peer)
+        self.prune(keep)
+        self._check_convergence(peers)
+
+    def _check_convergence(self, peers: Dict[Tuple[str, str], Dict[str, Any]]) -> None:
+        global _frr_converge_start
+        with _frr_status_lock:
+            start = _frr_converge_start
+        if start is None:
+            return
+        elapsed = time.monotonic() - start
+        if peers and all(info["state"] == "up" for info in peers.values()):
+            metrics.set("meduza_frr_convergence_seconds", elapsed)
+            self.put(f"{FRR_STATUS_BASE}/convergence", f"{elapsed:.1f}", stamped=True)
+            print(f"[frr-status] converged {elapsed:.1f}s after apply ({len(peers)} peer(s) up)", flush=True)
+        elif elapsed < FRR_CONVERGE_TIMEOUT:
+            return
+        else:
+            down = sorted(f"{p}/{n}" for (p, n), info in peers.items() if info["state"] != "up")
+            print(f"[frr-status] not converged {elapsed:.0f}s after apply, down: {', '.join(down) or '-'}", flush=True)
+        with _frr_status_lock:
+            if _frr_converge_start == start:
+                _frr_converge_start = None
+
+
+def frr_status_loop() -> None:
+    exporter = FrrStatusExporter()
+    while True:
+        time.sleep(max(3, FRR_STATUS_INTERVAL))
+        try:
+            exporter.poll()
+        except Exception as e:
+            print(f"[frr-status] poll failed: {e}", flush=True)
+
+
 # ---------- Network Mapping (NAT) ----------
 
-# Global state to track current NAT rules for removal
-_current_network_mappings: List[Tuple[str, str]] = []
 _network_mapping_lock = threading.Lock()
 _portforward_lock = threading.Lock()
 
+NETMAP_PREROUTING_CHAIN = "CLASH_NETMAP_PREROUTING"
+NETMAP_POSTROUTING_CHAIN = "CLASH_NETMAP_POSTROUTING"
 PORTFORWARD_PREROUTING_CHAIN = "CLASH_PORTFW_PREROUTING"
 PORTFORWARD_POSTROUTING_CHAIN = "CLASH_PORTFW_POSTROUTING"
 PORTFORWARD_FORWARD_CHAIN = "CLASH_PORTFW_FORWARD"
 
+_NETMAP_CHAINS: Dict[str, List[str]] = {"nat": [NETMAP_PREROUTING_CHAIN, NETMAP_POSTROUTING_CHAIN]}
+_NETMAP_JUMPS: Dict[str, List[str]] = {
+    "nat": [f"PREROUTING -j {NETMAP_PREROUTING_CHAIN}", f"POSTROUTING -j {NETMAP_POSTROUTING_CHAIN}"],
+}
+
+
+def _render_network_mapping_rules(mappings: List[Tuple[str, str, str, str]]) -> Dict[str, List[str]]:
+    """NETMAP rules of the owned chains, exactly as iptables-save prints them."""
+    import ipaddress
+
+    rules: List[str] = []
+    post: List[str] = []
+    seen: Set[Tuple[str, str]] = set()
+    for network_a, network_b, _, _ in mappings:
+        net_a = str(ipaddress.ip_network(network_a, strict=False))
+        net_b = str(ipaddress.ip_network(network_b, strict=False))
+        if (net_a, net_b) in seen:
+            continue
+        seen.add((net_a, net_b))
+        # PREROUTING: traffic arriving for network_a (advertised) goes to network_b
+        rules.append(f"-A {NETMAP_PREROUTING_CHAIN} -d {net_a} -j NETMAP --to {net_b}")
+        # POSTROUTING: traffic leaving network_b is translated to network_a
+        post.append(f"-A {NETMAP_POSTROUTING_CHAIN} -s {net_b} ! -d {net_b} -j NETMAP --to {net_a}")
+    return {"nat": rules + post}
+
+
+# The only rule older releases managed to install in a builtin chain: their
+# POSTROUTING rule used the invalid "-d ! net" spelling and was rejected.
+_LEGACY_NETMAP_RE = re.compile(r"^-A PREROUTING -d \d+\.\d+\.\d+\.\d+/\d+ -j NETMAP --to \d+\.\d+\.\d+\.\d+/\d+$")
+
+
+def migrate_legacy_network_mapping() -> None:
+    """Startup migration: drop NETMAP rules older releases appended to nat PREROUTING."""
+    try:
+        legacy = [line for line in _iptables_save("nat").splitlines() if _LEGACY_NETMAP_RE.match(line)]
+        if legacy:
+            _iptables_restore("*nat\n" + "".join("-D" + line[2:] + "\n" for line in legacy) + "COMMIT\n")
+            print(f"[network-mapping] removed {len(legacy)} legacy NETMAP rule(s) from PREROUTING", flush=True)
+    except Exception as e:
+        print(f"[network-mapping] legacy NETMAP migration failed: {e}", flush=True)
+
 
 def _apply_network_mapping_nat(
     mappings: List[Tuple[str, str, str, str]]
@@ -1019,34 +2245,33 @@ def _apply_network_mapping_nat(
     """
     Apply iptables NETMAP rules for network mapping.
 
+    The rules live in the CLASH_NETMAP_* chains and are diffed against
+    iptables-save: unchanged chains are left alone, changed ones are
+    replaced in one iptables-restore transaction.
+
     Args:
         mappings: List of (network_a, network_b, prefix_a, prefix_b) tuples
                  network_a: Advertised network (e.g., "192.168.1.0/24")
                  network_b: Actual local network (e.g., "10.100.1.0/24")
     """
-    global _current_network_mappings
+    if FIREWALL_BACKEND == "nftables":
+        _nft_apply("netmap", _nft_netmap_content(mappings) if mappings else None)
+        _remove_network_mapping_iptables()
+        print(f"[network-mapping] Applied {len(mappings)} network mapping(s) (nftables)", flush=True)
+        return
 
     with _network_mapping_lock:
-        # Remove old rules
-        _remove_network_mapping_nat()
-
-        # Apply new rules
-        for network_a, network_b, _, _ in mappings:
-            # POSTROUTING: SNAT from network_b to network_a
-            # Traffic leaving with source in network_b gets translated to network_a
-            run(
-                f"iptables -t nat -A POSTROUTING -s {network_b} -d ! {network_b} "
-                f"-j NETMAP --to {network_a}"
-            )
-            # PREROUTING: DNAT from network_a to network_b
-            # Traffic arriving with destination in network_a gets translated to network_b
-            run(
-                f"iptables -t nat -A PREROUTING -d {network_a} "
-                f"-j NETMAP --to {network_b}"
-            )
-
-        # Update current state
-        _current_network_mappings = [(net_a, net_b) for net_a, net_b, _, _ in mappings]
+        saved = {"nat": _iptables_save("nat")}
+        payload = _owned_chain_payload(
+            _NETMAP_CHAINS,
+            _NETMAP_JUMPS,
+            _render_network_mapping_rules(mappings),
+            saved,
+        )
+        if not payload:
+            print(f"[network-mapping] {len(mappings)} network mapping(s) already installed", flush=True)
+            return
+        _iptables_restore(payload)
 
         print(
             f"[network-mapping] Applied {len(mappings)} network mapping(s)",
@@ -1056,28 +2281,23 @@ def _apply_network_mapping_nat(
 
 def _remove_network_mapping_nat() -> None:
     """Remove all network mapping NAT rules."""
-    global _current_network_mappings
+    if FIREWALL_BACKEND == "nftables":
+        _nft_apply("netmap", None)
+    _remove_network_mapping_iptables()
 
-    with _network_mapping_lock:
-        for network_a, network_b in _current_network_mappings:
-            # Remove POSTROUTING rule
-            try:
-                run(
-                    f"iptables -t nat -D POSTROUTING -s {network_b} -d ! {network_b} "
-                    f"-j NETMAP --to {network_a}"
-                )
-            except Exception:
-                pass
-            # Remove PREROUTING rule
-            try:
-                run(
-                    f"iptables -t nat -D PREROUTING -d {network_a} "
-                    f"-j NETMAP --to {network_b}"
-                )
-            except Exception:
-                pass
 
-        _current_network_mappings = []
+def _remove_network_mapping_iptables() -> None:
+    """Remove the CLASH_NETMAP_* chains and their jumps."""
+    with _network_mapping_lock:
+        saved = {"nat": _iptables_save("nat")}
+        payload = _owned_chain_payload(
+            _NETMAP_CHAINS,
+            _NETMAP_JUMPS,
+            None,
+            saved,
+        )
+        if payload:
+            _iptables_restore(payload)
 
 
 def _parse_portforward_specs(raw: str) -> List[Tuple[int, str, int]]:
@@ -1120,147 +2340,372 @@ def _parse_portforward_specs(raw: str) -> List[Tuple[int, str, int]]:
     return sorted(out)
 
 
-def _iptables(args: List[str]) -> None:
-    subprocess.run(
-        ["iptables", *args],
-        check=True,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-
-
 def _sysctl_enable_ip_forward() -> None:
     subprocess.run(["sysctl", "-w", "net.ipv4.ip_forward=1"], check=True, stdout=subprocess.DEVNULL)
 
 
-def _ensure_iptables_chain(table: str, chain: str) -> None:
-    cp = subprocess.run(
-        ["iptables", "-t", table, "-S", chain],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-    if cp.returncode != 0:
-        _iptables(["-t", table, "-N", chain])
+def _iptables_save(table: str) -> str:
+    cp = subprocess.run(["iptables-save", "-t", table], capture_output=True, text=True, check=True)
+    return cp.stdout
 
 
-def _iptables_chain_exists(table: str, chain: str) -> bool:
-    cp = subprocess.run(
-        ["iptables", "-t", table, "-S", chain],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-    return cp.returncode == 0
+def _saved_chain_rules(saved: str, chains: List[str]) -> Dict[str, List[str]]:
+    """Rules ("-A ..." lines) of each of ``chains`` that exists in iptables-save output."""
+    out: Dict[str, List[str]] = {}
+    for line in saved.splitlines():
+        if line.startswith(":") and line[1:].split(" ", 1)[0] in chains:
+            out.setdefault(line[1:].split(" ", 1)[0], [])
+        elif line.startswith("-A ") and line.split(" ", 2)[1] in chains:
+            out.setdefault(line.split(" ", 2)[1], []).append(line)
+    return out
 
 
-def _ensure_iptables_jump(table: str, parent: str, rule: List[str]) -> None:
-    cp = subprocess.run(
-        ["iptables", "-t", table, "-C", parent, *rule],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
+def _iptables_restore(payload: str) -> None:
+    """Apply an iptables-restore payload; each table's COMMIT is one atomic transaction."""
+    cp = subprocess.run(["iptables-restore", "--noflush"], input=payload, capture_output=True, text=True)
     if cp.returncode != 0:
-        _iptables(["-t", table, "-A", parent, *rule])
+        raise RuntimeError(f"iptables-restore exit {cp.returncode}: {(cp.stderr or cp.stdout).strip()}")
 
 
-def _safe_delete_iptables_jump(table: str, parent: str, rule: List[str]) -> None:
-    try:
-        _iptables(["-t", table, "-D", parent, *rule])
-    except Exception:
-        pass
+# table -> owned chains, and the jumps into them from builtin chains
+_PORTFORWARD_CHAINS: Dict[str, List[str]] = {
+    "nat": [PORTFORWARD_PREROUTING_CHAIN, PORTFORWARD_POSTROUTING_CHAIN],
+    "filter": [PORTFORWARD_FORWARD_CHAIN],
+}
+_PORTFORWARD_JUMPS: Dict[str, List[str]] = {
+    "nat": [
+        f"PREROUTING -m addrtype --dst-type LOCAL -j {PORTFORWARD_PREROUTING_CHAIN}",
+        f"POSTROUTING -j {PORTFORWARD_POSTROUTING_CHAIN}",
+    ],
+    "filter": [f"FORWARD -j {PORTFORWARD_FORWARD_CHAIN}"],
+}
 
+# Rendered rules and the chains as iptables-save printed them right after the
+# last apply; an identical render over unchanged chains is not re-applied.
+_portforward_installed: Dict[str, Any] = {}
 
-def _flush_delete_iptables_chain(table: str, chain: str) -> None:
-    if not _iptables_chain_exists(table, chain):
-        return
-    try:
-        _iptables(["-t", table, "-F", chain])
-    except Exception:
-        pass
-    try:
-        _iptables(["-t", table, "-X", chain])
-    except Exception:
-        pass
 
+def _render_portforward_rules(specs: List[Tuple[int, str, int]]) -> Dict[str, List[str]]:
+    """Desired rules of the CLASH_PORTFW_* chains per table, as iptables-save prints them."""
+    import ipaddress
 
-def _remove_portforward_rules_unlocked() -> None:
-    _safe_delete_iptables_jump(
-        "nat",
-        "PREROUTING",
-        ["-m", "addrtype", "--dst-type", "LOCAL", "-j", PORTFORWARD_PREROUTING_CHAIN],
-    )
-    _safe_delete_iptables_jump("nat", "POSTROUTING", ["-j", PORTFORWARD_POSTROUTING_CHAIN])
-    _safe_delete_iptables_jump("filter", "FORWARD", ["-j", PORTFORWARD_FORWARD_CHAIN])
+    def host(value: str) -> str:
+        try:
+            return f"{ipaddress.IPv4Address(value)}/32"
+        except ValueError:
+            # A hostname is resolved by iptables; its saved form never matches
+            return value
+
+    rules: Dict[str, List[str]] = {"nat": [], "filter": []}
+    for listen_port, target_host, target_port in specs:
+        target = host(target_host)
+        for protocol in ("tcp", "udp"):
+            match = f"-p {protocol} -m {protocol}"
+            rules["nat"].append(
+                f"-A {PORTFORWARD_PREROUTING_CHAIN} {match} --dport {listen_port} "
+                f"-j DNAT --to-destination {target_host}:{target_port}"
+            )
+            rules["nat"].append(
+                f"-A {PORTFORWARD_POSTROUTING_CHAIN} -d {target} {match} --dport {target_port} "
+                f"-m conntrack --ctstate DNAT --ctorigdstport {listen_port} -j MASQUERADE"
+            )
+            rules["filter"].append(
+                f"-A {PORTFORWARD_FORWARD_CHAIN} -d {target} {match} --dport {target_port} "
+                f"-m conntrack --ctstate NEW,RELATED,ESTABLISHED -j ACCEPT"
+            )
+            rules["filter"].append(
+                f"-A {PORTFORWARD_FORWARD_CHAIN} -s {target} {match} --sport {target_port} "
+                f"-m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT"
+            )
+    return rules
 
-    _flush_delete_iptables_chain("nat", PORTFORWARD_PREROUTING_CHAIN)
-    _flush_delete_iptables_chain("nat", PORTFORWARD_POSTROUTING_CHAIN)
-    _flush_delete_iptables_chain("filter", PORTFORWARD_FORWARD_CHAIN)
+
+def _owned_chain_payload(
+    chains: Dict[str, List[str]],
+    jumps: Dict[str, List[str]],
+    rules: Optional[Dict[str, List[str]]],
+    saved: Dict[str, str],
+) -> str:
+    """iptables-restore --noflush payload installing ``rules`` into owned chains (None: removing them).
+
+    ``chains`` and ``jumps`` map a table to its owned chains and to the jumps
+    into them from builtin chains. A chain whose saved rules already equal
+    ``rules`` is left alone.
+    Returns "" when nothing has to change.
+    """
+    out: List[str] = []
+    for table, owned in chains.items():
+        existing = _saved_chain_rules(saved[table], owned)
+        present = [jump for jump in jumps[table] if f"-A {jump}" in saved[table].splitlines()]
+        body: List[str] = []
+        if rules is None:
+            body += [f"-D {jump}" for jump in present]
+            body += [f":{chain} - [0:0]" for chain in owned if chain in existing]
+            body += [f"-X {chain}" for chain in owned if chain in existing]
+        else:
+            for chain in owned:
+                wanted = [rule for rule in rules[table] if rule.split(" ", 2)[1] == chain]
+                if existing.get(chain) != wanted:
+                    # Declaring a chain with --noflush empties it; the new rules follow in the same commit.
+                    body += [f":{chain} - [0:0]"] + wanted
+            body += [f"-A {jump}" for jump in jumps[table] if jump not in present]
+        if body:
+            out += [f"*{table}"] + body + ["COMMIT"]
+    return "\n".join(out) + "\n" if out else ""
+
+
+def _portforward_saved_state(saved: Dict[str, str]) -> Dict[str, List[str]]:
+    state: Dict[str, List[str]] = {}
+    for table, chains in _PORTFORWARD_CHAINS.items():
+        for chain, lines in _saved_chain_rules(saved[table], chains).items():
+            state[chain] = lines
+        state[f"{table}:jumps"] = [l for l in saved[table].splitlines() if l[3:] in _PORTFORWARD_JUMPS[table]]
+    return state
 
 
 def _remove_portforward_rules() -> None:
     with _portforward_lock:
-        _remove_portforward_rules_unlocked()
+        saved = {table: _iptables_save(table) for table in _PORTFORWARD_CHAINS}
+        payload = _owned_chain_payload(_PORTFORWARD_CHAINS, _PORTFORWARD_JUMPS, None, saved)
+        if payload:
+            _iptables_restore(payload)
+        _portforward_installed.clear()
 
 
 def _apply_portforward_rules(specs: List[Tuple[int, str, int]]) -> None:
-    with _portforward_lock:
-        _remove_portforward_rules_unlocked()
+    """Install the port forward chains in one iptables-restore transaction.
 
-        if not specs:
-            print("[portforward] Removed all port forward rules", flush=True)
+    The chains are replaced in place, so existing forwards never disappear
+    while the new set is loaded. With the nftables backend the NAT rules are
+    nftables lookups, but the FORWARD accepts stay in iptables: an accept in
+    another table cannot override a DROP policy of the iptables FORWARD chain.
+    """
+    nft = FIREWALL_BACKEND == "nftables"
+    if nft:
+        with _portforward_lock:
+            _nft_apply("portforward", _nft_portforward_content(specs) if specs else None)
+
+    if not specs:
+        _remove_portforward_rules()
+        print("[portforward] Removed all port forward rules", flush=True)
+        return
+
+    with _portforward_lock:
+        rules = _render_portforward_rules(specs)
+        fingerprint = sha({"backend": FIREWALL_BACKEND, "rules": rules})
+        saved = {table: _iptables_save(table) for table in _PORTFORWARD_CHAINS}
+        if (
+            _portforward_installed.get("rules") == fingerprint
+            and _portforward_installed.get("saved") == _portforward_saved_state(saved)
+        ):
+            print(f"[portforward] {len(specs)} port forward rule(s) already installed", flush=True)
             return
 
         _sysctl_enable_ip_forward()
-        _ensure_iptables_chain("nat", PORTFORWARD_PREROUTING_CHAIN)
-        _ensure_iptables_chain("nat", PORTFORWARD_POSTROUTING_CHAIN)
-        _ensure_iptables_chain("filter", PORTFORWARD_FORWARD_CHAIN)
-
-        _ensure_iptables_jump(
-            "nat",
-            "PREROUTING",
-            ["-m", "addrtype", "--dst-type", "LOCAL", "-j", PORTFORWARD_PREROUTING_CHAIN],
-        )
-        _ensure_iptables_jump("nat", "POSTROUTING", ["-j", PORTFORWARD_POSTROUTING_CHAIN])
-        _ensure_iptables_jump("filter", "FORWARD", ["-j", PORTFORWARD_FORWARD_CHAIN])
-
-        for listen_port, target_host, target_port in specs:
-            for protocol in ("tcp", "udp"):
-                _iptables([
-                    "-t", "nat", "-A", PORTFORWARD_PREROUTING_CHAIN,
-                    "-p", protocol,
-                    "--dport", str(listen_port),
-                    "-j", "DNAT",
-                    "--to-destination", f"{target_host}:{target_port}",
-                ])
-                _iptables([
-                    "-t", "nat", "-A", PORTFORWARD_POSTROUTING_CHAIN,
-                    "-p", protocol,
-                    "-d", target_host,
-                    "--dport", str(target_port),
-                    "-m", "conntrack",
-                    "--ctstate", "DNAT",
-                    "--ctorigdstport", str(listen_port),
-                    "-j", "MASQUERADE",
-                ])
-                _iptables([
-                    "-A", PORTFORWARD_FORWARD_CHAIN,
-                    "-p", protocol,
-                    "-d", target_host,
-                    "--dport", str(target_port),
-                    "-m", "conntrack",
-                    "--ctstate", "NEW,ESTABLISHED,RELATED",
-                    "-j", "ACCEPT",
-                ])
-                _iptables([
-                    "-A", PORTFORWARD_FORWARD_CHAIN,
-                    "-p", protocol,
-                    "-s", target_host,
-                    "--sport", str(target_port),
-                    "-m", "conntrack",
-                    "--ctstate", "ESTABLISHED,RELATED",
-                    "-j", "ACCEPT",
-                ])
-
-        print(f"[portforward] Applied {len(specs)} port forward rule(s)", flush=True)
+        if nft:
+            # NAT chains left by the iptables backend go; the filter chain is kept
+            nat = {"nat": _PORTFORWARD_CHAINS["nat"]}
+            filter_ = {"filter": _PORTFORWARD_CHAINS["filter"]}
+            payload = _owned_chain_payload(nat, _PORTFORWARD_JUMPS, None, saved)
+            payload += _owned_chain_payload(filter_, _PORTFORWARD_JUMPS, rules, saved)
+        else:
+            payload = _owned_chain_payload(_PORTFORWARD_CHAINS, _PORTFORWARD_JUMPS, rules, saved)
+        if payload:
+            _iptables_restore(payload)
+        saved = {table: _iptables_save(table) for table in _PORTFORWARD_CHAINS}
+        _portforward_installed.clear()
+        _portforward_installed.update({"rules": fingerprint, "saved": _portforward_saved_state(saved)})
+
+        print(f"[portforward] Applied {len(specs)} port forward rule(s){' (nftables)' if nft else ''}", flush=True)
+
+
+# ---------- nftables ----------
+
+# Objects each domain owns in the nftables table, with their declarations.
+# A domain only ever touches its own objects, so the three writers share one
+# table without coordinating; the hook of a base chain is part of its name.
+_NFT_OBJECTS: Dict[str, Dict[str, str]] = {
+    "portforward": {
+        "map portfw_dnat": "type inet_proto . inet_service : ipv4_addr . inet_service;",
+        "set portfw_masquerade": "type inet_proto . ipv4_addr . inet_service . inet_service;",
+        "chain portfw_prerouting": "type nat hook prerouting priority dstnat; policy accept;",
+        "chain portfw_postrouting": "type nat hook postrouting priority srcnat; policy accept;",
+    },
+    "netmap": {
+        "set netmap_local": "type ipv4_addr . ipv4_addr; flags interval;",
+        "chain netmap_prerouting": "type nat hook prerouting priority dstnat; policy accept;",
+        "chain netmap_postrouting": "type nat hook postrouting priority srcnat; policy accept;",
+    },
+    "tproxy": {
+        "set tproxy_bypass_iif": "type ifname;",
+        "set tproxy_bypass_src": "type ipv4_addr; flags interval; auto-merge;",
+        "set tproxy_bypass_dst": "type ipv4_addr; flags interval; auto-merge;",
+        "set tproxy_bypass_dport": "type inet_proto . inet_service;",
+        "set tproxy_bypass_sport": "type inet_proto . inet_service;",
+        "set tproxy_sources": "type ipv4_addr; flags interval; auto-merge;",
+        "chain tproxy_prerouting": "type filter hook prerouting priority mangle; policy accept;",
+    },
+}
+
+
+def _nft(payload: str) -> None:
+    """Run an ``nft -f`` script; the whole script is one kernel transaction."""
+    cp = subprocess.run(["nft", "-f", "-"], input=payload, capture_output=True, text=True)
+    if cp.returncode != 0:
+        raise RuntimeError(f"nft exit {cp.returncode}: {(cp.stderr or cp.stdout).strip()}")
+
+
+def _nft_payload(domain: str, content: Optional[Dict[str, List[str]]]) -> str:
+    """nft script replacing ``domain``'s objects with ``content`` (None: deleting them).
+
+    ``content`` maps an object of _NFT_OBJECTS to its rules (chains) or
+    elements (sets and maps). Every object is declared first, so the flush
+    or delete that follows works whether or not it already existed.
+    """
+    table = f"ip {NFT_TABLE}"
+    objects = [(obj.split(" ", 1), decl) for obj, decl in _NFT_OBJECTS[domain].items()]
+    # Chains go first: a set cannot be deleted while a rule still refers to it.
+    objects.sort(key=lambda item: item[0][0] != "chain")
+    out = [f"add table {table}"]
+    out += [f"add {kind} {table} {name} {{ {decl} }}" for (kind, name), decl in objects]
+    out += [f"flush {kind} {table} {name}" for (kind, name), _ in objects]
+    if content is None:
+        out += [f"delete {kind} {table} {name}" for (kind, name), _ in objects]
+        return "\n".join(out) + "\n"
+    for (kind, name), _ in objects:
+        items = content.get(f"{kind} {name}", [])
+        if kind != "chain" and items:
+            out.append(f"add element {table} {name} {{ {', '.join(items)} }}")
+    for (kind, name), _ in objects:
+        if kind == "chain":
+            out += [f"add rule {table} {name} {rule}" for rule in content.get(f"{kind} {name}", [])]
+    return "\n".join(out) + "\n"
+
+
+def _nft_apply(domain: str, content: Optional[Dict[str, List[str]]]) -> None:
+    _nft(_nft_payload(domain, content))
+
+
+def _nft_chain_check(chain: str) -> List[str]:
+    """Journal check command proving one of our nftables chains exists."""
+    return ["nft", "list", "chain", "ip", NFT_TABLE, chain]
+
+
+def _nft_remove_table() -> None:
+    """Drop the nftables table left behind by a previous FIREWALL_BACKEND=nftables run."""
+    if not shutil.which("nft"):
+        return
+    cp = subprocess.run(["nft", "list", "table", "ip", NFT_TABLE], capture_output=True, text=True)
+    if cp.returncode != 0:
+        return
+    try:
+        _nft(f"delete table ip {NFT_TABLE}\n")
+        print(f"[nft] removed table ip {NFT_TABLE} (FIREWALL_BACKEND={FIREWALL_BACKEND})", flush=True)
+    except Exception as e:
+        print(f"[nft] failed to remove table ip {NFT_TABLE}: {e}", flush=True)
+
+
+def _nft_ipv4(host: str) -> Optional[str]:
+    """IPv4 address of a port forward target; hostnames are resolved once per apply."""
+    try:
+        return socket.gethostbyname(host)
+    except (OSError, UnicodeError):
+        return None
+
+
+def _nft_portforward_content(specs: List[Tuple[int, str, int]]) -> Dict[str, List[str]]:
+    """Port forwards as map/set elements behind a fixed set of lookup rules."""
+    dnat: Dict[str, str] = {}
+    masquerade: List[str] = []
+    for listen_port, target_host, target_port in specs:
+        addr = _nft_ipv4(target_host) if ":" not in target_host else None
+        if addr is None:
+            print(f"[portforward] nftables: skipping {listen_port}:{target_host}:{target_port} (no IPv4 address)", flush=True)
+            continue
+        for protocol in ("tcp", "udp"):
+            # A listen port forwarded twice keeps its first target, as the first DNAT rule would.
+            dnat.setdefault(f"{protocol} . {listen_port}", f"{addr} . {target_port}")
+            masquerade.append(f"{protocol} . {addr} . {target_port} . {listen_port}")
+    return {
+        "map portfw_dnat": [f"{key} : {value}" for key, value in dnat.items()],
+        "set portfw_masquerade": sorted(set(masquerade)),
+        "chain portfw_prerouting": [
+            "fib daddr type local meta l4proto { tcp, udp } dnat to meta l4proto . th dport map @portfw_dnat",
+        ],
+        "chain portfw_postrouting": [
+            "ct status dnat meta l4proto { tcp, udp } "
+            "meta l4proto . ip daddr . th dport . ct original proto-dst @portfw_masquerade masquerade",
+        ],
+    }
+
+
+def _nft_netmap_content(mappings: List[Tuple[str, str, str, str]]) -> Dict[str, List[str]]:
+    """NETMAP pairs as prefix-translation maps (network_a: advertised, network_b: local)."""
+    import ipaddress
+
+    # Host bits are dropped as for the iptables rules; nft rejects them in a map
+    pairs = sorted({
+        (str(ipaddress.ip_network(network_a, strict=False)), str(ipaddress.ip_network(network_b, strict=False)))
+        for network_a, network_b, _, _ in mappings
+    })
+    if not pairs:
+        return {}
+    dnat = ", ".join(f"{network_a} : {network_b}" for network_a, network_b in pairs)
+    snat = ", ".join(f"{network_b} : {network_a}" for network_a, network_b in pairs)
+    return {
+        "set netmap_local": sorted({f"{network_b} . {network_b}" for _, network_b in pairs}),
+        "chain netmap_prerouting": [f"dnat ip prefix to ip daddr map {{ {dnat} }}"],
+        "chain netmap_postrouting": [
+            # Traffic staying inside the local segment keeps its addresses.
+            "ip saddr . ip daddr @netmap_local return",
+            f"snat ip prefix to ip saddr map {{ {snat} }}",
+        ],
+    }
+
+
+def _nft_tproxy_content(
+    proxy_dst: List[str],
+    exclude_src: List[str],
+    exclude_ifaces: List[str],
+    exclude_ports: List[str],
+    protocol: str,
+    use_conntrack: bool,
+    exclude_rfc1918: bool,
+) -> Dict[str, List[str]]:
+    """The CLASH_TPROXY chain (see _render_tproxy_rules) as one chain of set lookups."""
+    protocols = [protocol] if protocol in ("tcp", "udp") else ["tcp", "udp"]
+    l4proto = protocols[0] if len(protocols) == 1 else "{ tcp, udp }"
+    bypass = _tproxy_port_bypass(exclude_ports, protocol)
+    src_match = "ct state { new, established, related } ct original ip saddr" if use_conntrack else "ip saddr"
+    return {
+        "set tproxy_bypass_iif": [json.dumps(iface) for iface in exclude_ifaces],
+        "set tproxy_bypass_src": list(exclude_src),
+        "set tproxy_bypass_dst": list(TPROXY_RFC1918) if exclude_rfc1918 else [],
+        "set tproxy_bypass_dport": sorted({f"{p} . {port}" for p, match, port in bypass if match == "dport"}),
+        "set tproxy_bypass_sport": sorted({f"{p} . {port}" for p, match, port in bypass if match == "sport"}),
+        "set tproxy_sources": list(proxy_dst),
+        "chain tproxy_prerouting": [
+            "iifname @tproxy_bypass_iif return",
+            "ip daddr @tproxy_bypass_dst return",
+            f"{src_match} @tproxy_bypass_src return",
+            "meta l4proto { tcp, udp } meta l4proto . th dport @tproxy_bypass_dport return",
+            "meta l4proto { tcp, udp } meta l4proto . th sport @tproxy_bypass_sport return",
+            f"meta l4proto {{ tcp, udp }} th dport {TPROXY_PORT} return",
+            f"meta l4proto {l4proto} ip saddr @tproxy_sources "
+            f"tproxy to :{TPROXY_PORT} meta mark set meta mark | {TPROXY_MARK} accept",
+        ],
+    }
+
+
+def _nft_tproxy_installed(protocol: str) -> bool:
+    cp = subprocess.run(_nft_chain_check("tproxy_prerouting"), capture_output=True, text=True)
+    if cp.returncode != 0:
+        return False
+    lines = [l for l in cp.stdout.splitlines() if f"tproxy to :{TPROXY_PORT}" in l]
+    if not lines:
+        return False
+    wanted = [protocol] if protocol in ("tcp", "udp") else ["tcp", "udp"]
+    return all(any(p in l for l in lines) for p in wanted)
 
 
 # ---------- Clash ----------
@@ -2123,6 +3568,40 @@ def healthy_port_loop() -> None:
             time.sleep(5)
 
 
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def metrics_http_loop() -> None:
+    host, _, port = METRICS_LISTEN.rpartition(":")
+    try:
+        addr = (host.strip("[]") or "0.0.0.0", int(port))
+    except ValueError:
+        print(f"[metrics] invalid METRICS_LISTEN={METRICS_LISTEN!r}; endpoint disabled", flush=True)
+        return
+    while True:
+        try:
+            server = ThreadingHTTPServer(addr, _MetricsHandler)
+            server.daemon_threads = True
+            print(f"[metrics] HTTP endpoint listening on {METRICS_LISTEN}/metrics", flush=True)
+            server.serve_forever()
+        except Exception as e:
+            print(f"[metrics] endpoint error: {e}", flush=True)
+            time.sleep(5)
+
+
 _PORT_SPEC_RE = re.compile(r"^(?:(?:in|out):)?(?:(?:tcp|udp):)?\d+$")
 
 
@@ -2132,7 +3611,7 @@ def _is_valid_port_spec(val: str) -> bool:
 
 
 def _clash_exclude_ports(node: Dict[str, str], global_cfg: Dict[str, str]) -> List[str]:
-    raw = load_key(f"/nodes/{NODE_ID}/clash/exclude_tproxy_port")
+    raw = node.get(f"/nodes/{NODE_ID}/clash/exclude_tproxy_port", "")
     ports: Set[str] = set()
     for item in _split_ml(raw):
         if _is_valid_port_spec(item):
@@ -2178,6 +3657,192 @@ def _clash_exclude_ports(node: Dict[str, str], global_cfg: Dict[str, str]) -> Li
     return sorted(ports)
 
 
+# Destinations bypassed when /nodes/<id>/clash/exclude_rfc1918 is set
+TPROXY_RFC1918 = ("10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16")
+
+TPROXY_CHAIN = "CLASH_TPROXY"
+_TPROXY_CHAINS: Dict[str, List[str]] = {"mangle": [TPROXY_CHAIN]}
+# PREROUTING only: local-originated traffic (OUTPUT) is never proxied.
+_TPROXY_JUMPS: Dict[str, List[str]] = {"mangle": [f"PREROUTING -j {TPROXY_CHAIN}"]}
+_tproxy_lock = threading.Lock()
+
+# Fingerprint of the TPROXY state the last apply installed and, for iptables,
+# the CLASH_TPROXY chain as iptables-save printed it right after. An identical
+# render is not re-applied, and the check loop compares the live chain with it.
+_tproxy_installed: Dict[str, Any] = {}
+
+
+def _tproxy_port_bypass(exclude_ports: List[str], protocol: str) -> List[Tuple[str, str, str]]:
+    """Expand ``[(in|out):][(tcp|udp):]<port>`` specs into (protocol, dport|sport, port).
+
+    A spec naming a protocol that is not proxied is dropped; one without a
+    protocol covers every proxied one. Without a direction both dport and
+    sport are bypassed: "22", "udp:53", "in:80" (dport only), "out:tcp:8080"
+    (sport only).
+    """
+    enabled = [protocol] if protocol in ("tcp", "udp") else ["tcp", "udp"]
+    out: List[Tuple[str, str, str]] = []
+    for spec in exclude_ports:
+        if not _is_valid_port_spec(spec):
+            print(f"[tproxy] skipping invalid exclude port spec: {spec!r}", flush=True)
+            continue
+        parts = spec.strip().split(":")
+        port = int(parts[-1])
+        if not 1 <= port <= 65535:
+            print(f"[tproxy] skipping invalid exclude port: {spec!r}", flush=True)
+            continue
+        direction = parts[0] if parts[0] in ("in", "out") else ""
+        proto = parts[-2] if len(parts) > 1 and parts[-2] in ("tcp", "udp") else ""
+        if proto and proto not in enabled:
+            continue
+        for match in {"in": ["dport"], "out": ["sport"]}.get(direction, ["dport", "sport"]):
+            for p in [proto] if proto else enabled:
+                out.append((p, match, str(port)))
+    return out
+
+
+def _render_tproxy_rules(
+    proxy_dst: List[str],
+    exclude_src: List[str],
+    exclude_ifaces: List[str],
+    exclude_ports: List[str],
+    protocol: str,
+    use_conntrack: bool,
+    exclude_rfc1918: bool,
+) -> Dict[str, List[str]]:
+    """The CLASH_TPROXY chain as iptables-restore lines, spelled the way iptables-save prints them.
+
+    Bypasses come first (ingress interfaces, RFC1918 destinations, source
+    CIDRs, ports, Mihomo's own port), then one TPROXY rule per proxied
+    source and protocol.
+    """
+    import ipaddress
+
+    def cidr(value: str) -> str:
+        return str(ipaddress.ip_network(value.strip(), strict=False))
+
+    def ctaddr(value: str) -> str:
+        # The conntrack match prints a host address without its /32
+        net = ipaddress.ip_network(value.strip(), strict=False)
+        return str(net.network_address) if net.prefixlen == net.max_prefixlen else str(net)
+
+    protocols = [protocol] if protocol in ("tcp", "udp") else ["tcp", "udp"]
+    rules = [f"-A {TPROXY_CHAIN} -i {iface} -j RETURN" for iface in exclude_ifaces]
+    if exclude_rfc1918:
+        rules += [f"-A {TPROXY_CHAIN} -d {dst} -j RETURN" for dst in TPROXY_RFC1918]
+    for src in exclude_src:
+        if use_conntrack:
+            # Original source of the connection, so replies to excluded sources are bypassed too
+            rules.append(
+                f"-A {TPROXY_CHAIN} -m conntrack --ctstate NEW,RELATED,ESTABLISHED --ctorigsrc {ctaddr(src)} -j RETURN"
+            )
+        else:
+            rules.append(f"-A {TPROXY_CHAIN} -s {cidr(src)} -j RETURN")
+    for p, match, port in _tproxy_port_bypass(exclude_ports, protocol):
+        rules.append(f"-A {TPROXY_CHAIN} -p {p} -m {p} --{match} {port} -j RETURN")
+    for p in ("tcp", "udp"):
+        rules.append(f"-A {TPROXY_CHAIN} -p {p} -m {p} --dport {TPROXY_PORT} -j RETURN")
+    for src in proxy_dst:
+        for p in protocols:
+            rules.append(
+                f"-A {TPROXY_CHAIN} -s {cidr(src)} -p {p} -j TPROXY --on-port {TPROXY_PORT} "
+                f"--on-ip 0.0.0.0 --tproxy-mark {TPROXY_MARK}/{TPROXY_MARK}"
+            )
+    return {"mangle": rules}
+
+
+def _tproxy_fingerprint(
+    proxy_dst: List[str],
+    exclude_src: List[str],
+    exclude_ifaces: List[str],
+    exclude_ports: List[str],
+    protocol: str,
+    use_conntrack: bool,
+    exclude_rfc1918: bool,
+) -> str:
+    """Fingerprint of everything an apply with these settings installs."""
+    args = (proxy_dst, exclude_src, exclude_ifaces, exclude_ports, protocol, use_conntrack, exclude_rfc1918)
+    rules = _nft_tproxy_content(*args) if FIREWALL_BACKEND == "nftables" else _render_tproxy_rules(*args)
+    return sha({
+        "backend": FIREWALL_BACKEND,
+        "rules": rules,
+        "jumps": _TPROXY_JUMPS,
+        "ipset": PROXY_IPSET_NAME,
+        "rule": ["pref", "100", "fwmark", TPROXY_MARK, "table", TPROXY_ROUTE_TABLE],
+        "route": ["local", "0.0.0.0/0", "dev", "lo", "table", TPROXY_ROUTE_TABLE],
+    })
+
+
+def _tproxy_iptables_remove() -> None:
+    """Remove CLASH_TPROXY and its PREROUTING jump in one iptables-restore transaction."""
+    saved = {"mangle": _iptables_save("mangle")}
+    payload = _owned_chain_payload(_TPROXY_CHAINS, _TPROXY_JUMPS, None, saved)
+    if payload:
+        _iptables_restore(payload)
+
+
+def _tproxy_sysctls() -> None:
+    for setting in (
+        "net.ipv4.ip_forward=1",
+        "net.ipv4.conf.all.route_localnet=1",
+        "net.ipv4.conf.all.rp_filter=0",
+        "net.ipv4.conf.default.rp_filter=0",
+    ):
+        subprocess.run(["sysctl", "-w", setting], check=True, stdout=subprocess.DEVNULL)
+
+
+def _tproxy_routing_installed() -> bool:
+    """Policy routing that delivers TPROXY-marked packets locally (one ``ip -batch``)."""
+    cp = subprocess.run(
+        ["ip", "-force", "-batch", "-"],
+        input=f"rule list\nroute show table {TPROXY_ROUTE_TABLE}\n",
+        capture_output=True,
+        text=True,
+    )
+    if f"fwmark {TPROXY_MARK} lookup {TPROXY_ROUTE_TABLE}" not in cp.stdout:
+        return False
+    # iproute2 prints the 0.0.0.0/0 route as "default"
+    return "local default dev lo" in cp.stdout or "local 0.0.0.0/0 dev lo" in cp.stdout
+
+
+def _tproxy_routing_apply() -> None:
+    if not _tproxy_routing_installed():
+        _tproxy_routing_remove()
+        subprocess.run(
+            ["ip", "rule", "add", "pref", "100", "fwmark", TPROXY_MARK, "table", TPROXY_ROUTE_TABLE], check=True
+        )
+    subprocess.run(
+        ["ip", "route", "replace", "local", "0.0.0.0/0", "dev", "lo", "table", TPROXY_ROUTE_TABLE], check=True
+    )
+
+
+def _tproxy_routing_remove() -> None:
+    for cmd in (
+        ["ip", "rule", "del", "pref", "100", "fwmark", TPROXY_MARK, "table", TPROXY_ROUTE_TABLE],
+        ["ip", "rule", "del", "fwmark", TPROXY_MARK, "table", TPROXY_ROUTE_TABLE],
+        ["ip", "route", "flush", "table", TPROXY_ROUTE_TABLE],
+    ):
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _nft_tproxy_apply(
+    proxy_dst: List[str],
+    exclude_src: List[str],
+    exclude_ifaces: List[str],
+    exclude_ports: List[str],
+    protocol: str,
+    use_conntrack: bool,
+    exclude_rfc1918: bool,
+) -> None:
+    _tproxy_sysctls()
+    _nft_apply("tproxy", _nft_tproxy_content(
+        proxy_dst, exclude_src, exclude_ifaces, exclude_ports, protocol, use_conntrack, exclude_rfc1918,
+    ))
+    # A CLASH_TPROXY chain left by the iptables backend would mark packets twice.
+    _tproxy_iptables_remove()
+    _tproxy_routing_apply()
+
+
 def tproxy_apply(
     proxy_dst: List[str],
     exclude_src: List[str],
@@ -2191,6 +3856,11 @@ def tproxy_apply(
     """
     Apply TPROXY rules in include mode (only proxy specified destinations).
 
+    The whole CLASH_TPROXY chain is rendered here and swapped in by one
+    iptables-restore commit (a no-op when it already matches iptables-save),
+    so reapplying never leaves LAN traffic unproxied; the policy routing
+    is only added when missing.
+
     Args:
         proxy_dst: List of CIDRs to proxy (from /lan configuration)
         exclude_src: Source CIDRs to bypass proxy
@@ -2204,23 +3874,42 @@ def tproxy_apply(
     if isinstance(exclude_ports, str):
         raise TypeError(f"exclude_ports must be a list of strings, got str: {exclude_ports!r}")
 
-    run(
-        f"PROXY_CIDRS='{ ' '.join(proxy_dst) }' "
-        f"EXCLUDE_SRC_CIDRS='{ ' '.join(exclude_src) }' "
-        f"EXCLUDE_IFACES='{ ' '.join(exclude_ifaces) }' "
-        f"EXCLUDE_IPS='{ ' '.join(exclude_ips) }' "
-        f"EXCLUDE_PORTS='{ ' '.join(exclude_ports) }' "
-        f"PROXY_IPSET_NAME='{PROXY_IPSET_NAME}' "
-        f"PROTOCOL='{protocol}' "
-        f"USE_CONNTRACK='{ 'true' if use_conntrack else 'false' }' "
-        f"EXCLUDE_RFC1918='{ 'true' if exclude_rfc1918 else 'false' }' "
-        f"TPROXY_PORT={TPROXY_PORT} MARK=0x1 TABLE=100 "
-        f"/usr/local/bin/tproxy.sh apply"
-    )
+    args = (proxy_dst, exclude_src, exclude_ifaces, exclude_ports, protocol, use_conntrack, exclude_rfc1918)
+    with _tproxy_lock:
+        _tproxy_installed.clear()
+        if FIREWALL_BACKEND == "nftables":
+            _nft_tproxy_apply(*args)
+            _tproxy_installed.update({"fingerprint": _tproxy_fingerprint(*args), "chain": None, "protocol": protocol})
+            return
+
+        rules = _render_tproxy_rules(*args)
+        _tproxy_sysctls()
+        saved = {"mangle": _iptables_save("mangle")}
+        payload = _owned_chain_payload(_TPROXY_CHAINS, _TPROXY_JUMPS, rules, saved)
+        if payload:
+            _iptables_restore(payload)
+            saved = {"mangle": _iptables_save("mangle")}
+        _tproxy_routing_apply()
+        _tproxy_installed.update({
+            "fingerprint": _tproxy_fingerprint(*args),
+            "chain": _saved_chain_rules(saved["mangle"], [TPROXY_CHAIN]).get(TPROXY_CHAIN, []),
+            "protocol": protocol,
+        })
+        print(
+            f"[tproxy] {len(rules['mangle'])} rule(s) in {TPROXY_CHAIN}"
+            f"{'' if payload else ' already installed'}",
+            flush=True,
+        )
 
 
 def tproxy_remove() -> None:
-    run(f"TPROXY_PORT={TPROXY_PORT} MARK=0x1 TABLE=100 /usr/local/bin/tproxy.sh remove")
+    with _tproxy_lock:
+        _tproxy_installed.clear()
+        if FIREWALL_BACKEND == "nftables":
+            _nft_apply("tproxy", None)
+        else:
+            _tproxy_iptables_remove()
+        _tproxy_routing_remove()
 
 
 def _apply_tproxy_with_verify(
@@ -2235,6 +3924,13 @@ def _apply_tproxy_with_verify(
     retries: int = 3,
     delay_seconds: float = 1.0,
 ) -> None:
+    fingerprint = _tproxy_fingerprint(
+        proxy_dst, exclude_src, exclude_ifaces, exclude_ports, protocol, use_conntrack, exclude_rfc1918,
+    )
+    if _tproxy_installed.get("fingerprint") == fingerprint and _check_tproxy_iptables(protocol):
+        print(f"[tproxy] rules unchanged ({fingerprint[:12]}), skipping apply", flush=True)
+        return
+
     last_error: Optional[Exception] = None
     for attempt in range(1, retries + 1):
         try:
@@ -2274,29 +3970,28 @@ def _set_cached_tproxy_targets(targets: List[str]) -> None:
     _cached_tproxy_targets = list(targets)
 
 
-def _check_tproxy_iptables(protocol: str = "tcp+udp") -> bool:
-    """Check if tproxy iptables rules are correctly applied."""
+def _check_tproxy_iptables(protocol: str) -> bool:
+    """Check if tproxy iptables rules are correctly applied.
+
+    One ``iptables-save -t mangle`` is parsed; the CLASH_TPROXY chain must
+    equal the one recorded by the last apply (without a record, it must at
+    least hold the TPROXY rules for ``protocol``).
+    """
     try:
-        cp = subprocess.run(
-            ["iptables", "-t", "mangle", "-S", "CLASH_TPROXY"],
-            capture_output=True,
-            text=True,
-        )
-        if cp.returncode != 0:
-            return False
-        chain_rules = cp.stdout
+        if FIREWALL_BACKEND == "nftables":
+            return _nft_tproxy_installed(protocol) and _tproxy_routing_installed()
 
-        cp = subprocess.run(
-            ["iptables", "-t", "mangle", "-S", "PREROUTING"],
-            capture_output=True,
-            text=True,
-        )
-        if cp.returncode != 0:
+        saved = _iptables_save("mangle")
+        if f"-A {_TPROXY_JUMPS['mangle'][0]}" not in saved.splitlines():
             return False
-
-        if "-j CLASH_TPROXY" not in cp.stdout:
+        rules = _saved_chain_rules(saved, [TPROXY_CHAIN]).get(TPROXY_CHAIN)
+        if rules is None:
             return False
+        installed = _tproxy_installed.get("chain")
+        if installed is not None:
+            return rules == installed and _tproxy_routing_installed()
 
+        chain_rules = "\n".join(rules)
         if "-j TPROXY" not in chain_rules:
             return False
         if f"--on-port {TPROXY_PORT}" not in chain_rules:
@@ -2306,27 +4001,7 @@ def _check_tproxy_iptables(protocol: str = "tcp+udp") -> bool:
         if protocol in ("udp", "tcp+udp") and "-p udp" not in chain_rules:
             return False
 
-        cp = subprocess.run(
-            ["ip", "rule", "list"],
-            capture_output=True,
-            text=True,
-        )
-        if cp.returncode != 0:
-            return False
-        if "fwmark 0x1" not in cp.stdout or "lookup 100" not in cp.stdout:
-            return False
-
-        cp = subprocess.run(
-            ["ip", "route", "show", "table", "100"],
-            capture_output=True,
-            text=True,
-        )
-        if cp.returncode != 0:
-            return False
-        if "local 0.0.0.0/0 dev lo" not in cp.stdout:
-            return False
-
-        return True
+        return _tproxy_routing_installed()
     except Exception as e:
         print(f"[tproxy-check] error checking iptables: {e}", flush=True)
         return False
@@ -2371,9 +4046,10 @@ def tproxy_check_loop() -> None:
                 enabled = _tproxy_check_enabled
             if not enabled or not tproxy_enabled:
                 continue
-
-            # Rules are missing or incorrect, reapply them
-            print(f"[tproxy-check] tproxy iptables rules missing or incorrect, fixing...", flush=True)
+            # The last apply recorded its protocol; checking against it needs no etcd read
+            installed_protocol = _tproxy_installed.get("protocol")
+            if installed_protocol and _check_tproxy_iptables(installed_protocol):
+                continue
 
             # Load current configuration
             node = load_prefix(f"/nodes/{NODE_ID}/")
@@ -2382,9 +4058,12 @@ def tproxy_check_loop() -> None:
             tproxy_protocol = node.get(f"/nodes/{NODE_ID}/clash/tproxy_protocol", "tcp+udp")
             use_conntrack = node.get(f"/nodes/{NODE_ID}/clash/use_conntrack", "false") == "true"
             exclude_rfc1918 = node.get(f"/nodes/{NODE_ID}/clash/exclude_rfc1918", "false") == "true"
-            if _check_tproxy_iptables(tproxy_protocol):
+            if not installed_protocol and _check_tproxy_iptables(tproxy_protocol):
                 continue
 
+            # Rules are missing or incorrect, reapply them
+            print(f"[tproxy-check] tproxy iptables rules missing or incorrect, fixing...", flush=True)
+
             # Reapply tproxy rules (using ipset, no individual IPs needed)
             _fix_tproxy_iptables(
                 _get_cached_tproxy_targets(),
@@ -2767,42 +4446,357 @@ def reload_mosdns(node: Dict[str, str], global_cfg: Dict[str, str]) -> None:
         _update_dnsmasq_upstreams(add_mosdns=True, add_clash=clash_enabled)
 
 
+# ---------- reconcile journal ----------
+# Per-domain hashes, the artifacts each domain wrote and the in-memory state it
+# set up, persisted so a watcher restart does not re-apply unchanged domains.
+# /run survives a watcher restart but not a container restart, which also
+# restarts every managed process and therefore needs a full apply anyway.
+RECONCILE_JOURNAL_PATH = os.environ.get("RECONCILE_JOURNAL", "/run/meduza/reconcile-journal.json")
+RECONCILE_JOURNAL_VERSION = 1
+
+# The healthy listener lives inside this process, so it is always re-created.
+_UNJOURNALED_DOMAINS = {"healthy"}
+
+_journal_lock = threading.Lock()
+_journal_save_lock = threading.Lock()
+_journal: Dict[str, Dict[str, Any]] = {}
+# Paths written through _write_text()/_write_if_changed() while a domain is applied
+_journal_capture = threading.local()
+
+
+def _journal_note_write(path: str) -> None:
+    paths = getattr(_journal_capture, "paths", None)
+    if paths is not None:
+        paths.add(path)
+
+
+def _journal_begin() -> None:
+    _journal_capture.paths = set()
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    except OSError:
+        return ""
+    return h.hexdigest()
+
+
+def _journal_commit(
+    domain: str,
+    digest: str,
+    programs: Optional[List[str]] = None,
+    checks: Optional[List[List[str]]] = None,
+    artifacts: Optional[List[str]] = None,
+    state: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Record a successfully applied domain.
+
+    Args:
+        domain: Domain key (same as in last_hash)
+        digest: Hash of the material the domain was applied from
+        programs: supervisor programs that must be RUNNING for the domain to be intact
+        checks: Commands that must exit 0 (e.g. iptables chain presence)
+        artifacts: Files written outside _write_text() that belong to the domain
+        state: JSON-serializable in-memory state restored by _journal_restore_state()
+    """
+    paths = set(getattr(_journal_capture, "paths", None) or ()) | set(artifacts or ())
+    _journal_capture.paths = None
+    last_hash[domain] = digest
+    if domain in _UNJOURNALED_DOMAINS:
+        return
+    with _journal_lock:
+        _journal[domain] = {
+            "hash": digest,
+            "artifacts": sorted(paths),
+            "programs": sorted(programs or []),
+            "checks": [list(c) for c in (checks or [])],
+            "state": state or {},
+        }
+    _journal_save()
+
+
+def _journal_forget(domain: str) -> None:
+    last_hash.pop(domain, None)
+    with _journal_lock:
+        if _journal.pop(domain, None) is None:
+            return
+    _journal_save()
+
+
+def _journal_save() -> None:
+    # File hashes are taken at save time so later writes by other domains
+    # (e.g. clash/mosdns updating dnsmasq.conf) are part of the recorded state.
+    # Domains finish concurrently; the save lock keeps an older document from
+    # replacing a newer one.
+    with _journal_save_lock:
+        with _journal_lock:
+            records = {d: dict(rec) for d, rec in _journal.items()}
+        domains = {
+            d: dict(rec, files={p: _file_sha256(p) for p in rec["artifacts"]})
+            for d, rec in records.items()
+        }
+        doc = {"version": RECONCILE_JOURNAL_VERSION, "node_id": NODE_ID, "domains": domains}
+        try:
+            os.makedirs(os.path.dirname(RECONCILE_JOURNAL_PATH), mode=0o700, exist_ok=True)
+            tmp = RECONCILE_JOURNAL_PATH + ".tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(doc, f, sort_keys=True)
+            os.replace(tmp, RECONCILE_JOURNAL_PATH)
+        except Exception as e:
+            print(f"[journal] failed to save {RECONCILE_JOURNAL_PATH}: {e}", flush=True)
+
+
+def _journal_verify(rec: Dict[str, Any], statuses: Dict[str, str]) -> str:
+    """Return why the live state no longer matches ``rec``, or "" if it does."""
+    for path, digest in rec.get("files", {}).items():
+        if _file_sha256(path) != digest:
+            return f"artifact {path} changed"
+    for name in rec.get("programs", []):
+        if statuses.get(name) != "RUNNING":
+            return f"program {name} is {statuses.get(name) or 'missing'}"
+    for cmd in rec.get("checks", []):
+        try:
+            cp = subprocess.run(cmd, capture_output=True, text=True)
+        except Exception as e:
+            return f"check {' '.join(cmd)} failed: {e}"
+        if cp.returncode != 0:
+            return f"check {' '.join(cmd)} failed"
+    return ""
+
+
+def _journal_restore_state(domain: str, state: Dict[str, Any]) -> None:
+    global tproxy_enabled, CLASH_API_SECRET
+    global _clash_refresh_enable, _clash_refresh_interval, _clash_refresh_next
+    global _tproxy_check_enabled, _clash_monitoring_enabled, _frr_applied_model, _last_latency_costs
+
+    if domain in ("openvpn", "access"):
+        with _ovpn_lock:
+            _ovpn_devs.update(state.get("devs", {}))
+            for name in state.get("devs", {}):
+                if name not in _ovpn_cfg_names:
+                    _ovpn_cfg_names.append(name)
+            _ovpn_cfg_names.sort()
+    elif domain == "wireguard":
+        with _wg_lock:
+            _wg_devs.update(state.get("devs", {}))
+            _wg_cfg_names[:] = sorted(state.get("devs", {}))
+    elif domain == "portforward":
+        with _portforward_lock:
+            _portforward_installed.clear()
+            _portforward_installed.update(state.get("installed", {}))
+    elif domain == "frr":
+        _frr_applied_model = state.get("frr_model")
+        set_latency_targets(state.get("latency_targets", {}))
+        restore_latency(state.get("latency_costs", {}), state.get("latency_smoothed", {}))
+        _last_latency_costs = latency_costs()
+    elif domain == "clash" and state.get("enabled"):
+        CLASH_API_SECRET = state.get("api_secret", "")
+        with _clash_refresh_lock:
+            _clash_refresh_enable = bool(state.get("refresh_enable"))
+            _clash_refresh_interval = int(state.get("refresh_interval", 0))
+            _clash_refresh_next = time.time() + (_clash_refresh_interval * 60)
+        if state.get("tproxy"):
+            _set_cached_tproxy_targets(state.get("tproxy_targets", []))
+            with _tproxy_lock:
+                _tproxy_installed.clear()
+                _tproxy_installed.update(state.get("tproxy_installed", {}))
+            tproxy_enabled = True
+            with _tproxy_check_lock:
+                _tproxy_check_enabled = True
+            with _clash_monitoring_lock:
+                _clash_monitoring_enabled = True
+            _ensure_proxy_ipset()
+            threading.Thread(target=_update_proxy_ips_async, daemon=True).start()
+
+
+def load_reconcile_journal() -> None:
+    """Trust journaled domain hashes whose live state still matches.
+
+    Domains that fail verification (artifact changed, program not RUNNING,
+    check failed) are left out of last_hash and re-applied by the first
+    reconcile.
+    """
+    try:
+        with open(RECONCILE_JOURNAL_PATH, "r", encoding="utf-8") as f:
+            doc = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"[journal] ignoring unreadable {RECONCILE_JOURNAL_PATH}: {e}", flush=True)
+        return
+    if doc.get("version") != RECONCILE_JOURNAL_VERSION or doc.get("node_id") != NODE_ID:
+        print("[journal] version/node mismatch, ignoring", flush=True)
+        return
+
+    statuses = _supervisor_status_all()
+    trusted: List[str] = []
+    for domain, rec in sorted(doc.get("domains", {}).items()):
+        problem = _journal_verify(rec, statuses)
+        if problem:
+            print(f"[journal] {domain}: {problem}; will re-apply", flush=True)
+            continue
+        try:
+            _journal_restore_state(domain, rec.get("state", {}))
+        except Exception as e:
+            print(f"[journal] {domain}: failed to restore state: {e}; will re-apply", flush=True)
+            continue
+        last_hash[domain] = rec["hash"]
+        with _journal_lock:
+            _journal[domain] = {k: v for k, v in rec.items() if k != "files"}
+        trusted.append(domain)
+    print(f"[journal] restored {len(trusted)} domain(s): {', '.join(trusted) or '-'}", flush=True)
+
+
 # ---------- reconcile ----------
 
+RECONCILE_WORKERS = max(1, int(os.environ.get("RECONCILE_WORKERS", "4")))
+
+# Domain task -> tasks that must have succeeded first.
+# - dnsmasq starts first so DNS is available to everything else.
+# - access shares the OpenVPN device/program bookkeeping with openvpn.
+# - iptables writers are serialized: portforward -> frr (NETMAP) -> clash (TPROXY),
+#   which also keeps TPROXY after FRR as before.
+# - mosdns downloads its rules through Clash and updates dnsmasq after it.
+RECONCILE_DEPENDENCIES: Dict[str, Tuple[str, ...]] = {
+    "dnsmasq": (),
+    "healthy": ("dnsmasq",),
+    "portforward": ("dnsmasq",),
+    "mesh": ("dnsmasq",),
+    "openvpn": ("dnsmasq",),
+    "access": ("openvpn",),
+    "wireguard": ("dnsmasq",),
+    "frr": ("portforward",),
+    "clash": ("frr",),
+    "mosdns": ("clash",),
+}
+
+
+def _metered_task(name: str, fn: Any, durations: Dict[str, float]) -> Any:
+    """Run one domain task, recording its duration, subprocess count and outcome."""
+    _metrics_ctx.domain = name
+    _metrics_ctx.subprocesses = 0
+    start = time.monotonic()
+    ok = False
+    try:
+        result = fn()
+        ok = True
+        if result:
+            metrics.inc("meduza_reconcile_domain_applied_total", domain=name)
+        return result
+    finally:
+        elapsed = time.monotonic() - start
+        durations[name] = elapsed
+        metrics.observe("meduza_reconcile_domain_duration_seconds", elapsed, domain=name)
+        metrics.set("meduza_reconcile_domain_last_duration_seconds", elapsed, domain=name)
+        metrics.set("meduza_reconcile_domain_subprocesses", _metrics_ctx.subprocesses, domain=name)
+        if not ok:
+            metrics.inc("meduza_reconcile_domain_errors_total", domain=name)
+        _metrics_ctx.domain = None
+
+
+def _run_reconcile_tasks(
+    tasks: Dict[str, Any],
+    deps: Dict[str, Tuple[str, ...]],
+    workers: int,
+    durations: Optional[Dict[str, float]] = None,
+) -> Tuple[Dict[str, bool], Optional[BaseException]]:
+    """Run domain tasks on a bounded pool, each once its dependencies succeeded.
+
+    Tasks whose dependency failed (or was skipped) are skipped. Returns each
+    finished task's result and the first error raised, if any; per-task
+    durations are stored in ``durations`` when given.
+    """
+    if durations is None:
+        durations = {}
+    results: Dict[str, bool] = {}
+    failed: Dict[str, BaseException] = {}
+    skipped: Set[str] = set()
+    remaining = dict(tasks)
+    running: Dict[Any, str] = {}
+    first_error: Optional[BaseException] = None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reconcile") as pool:
+        while remaining or running:
+            progress = True
+            while progress:
+                progress = False
+                for name in list(remaining):
+                    needs = deps.get(name, ())
+                    blocked = [d for d in needs if d in failed or d in skipped]
+                    if blocked:
+                        print(f"[reconcile] {name} skipped: dependency {', '.join(blocked)} did not complete", flush=True)
+                        skipped.add(name)
+                        del remaining[name]
+                        progress = True
+                    elif all(d in results or d not in tasks for d in needs):
+                        running[pool.submit(_metered_task, name, remaining.pop(name), durations)] = name
+            if not running:
+                if remaining:
+                    raise RuntimeError(f"unsatisfiable reconcile dependencies: {sorted(remaining)}")
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                err = fut.exception()
+                if err is not None:
+                    print(f"[reconcile] {name} failed: {err}", flush=True)
+                    failed[name] = err
+                    if first_error is None:
+                        first_error = err
+                else:
+                    results[name] = bool(fut.result())
+    return results, first_error
+
+
+
 def handle_commit() -> None:
-    global reconcile_force, tproxy_enabled
-    global _clash_refresh_enable, _clash_refresh_interval, _clash_refresh_next
-    global _tproxy_check_enabled
+    global reconcile_force, _last_snapshot_fingerprint, _last_latency_costs
 
-    node = load_prefix(f"/nodes/{NODE_ID}/")
-    global_cfg = load_prefix("/global/")
-    all_nodes_cache: Optional[Dict[str, str]] = None
+    snapshot = load_snapshot(min_revision=_commit_revision)
+    latency = latency_costs()
+    if not reconcile_force and snapshot.fingerprint == _last_snapshot_fingerprint and latency == _last_latency_costs:
+        print(
+            f"[reconcile] snapshot unchanged (rev={snapshot.revision} mod_rev={snapshot.mod_revision} "
+            f"keys={snapshot.key_count}), skipping",
+            flush=True,
+        )
+        metrics.inc("meduza_reconcile_skipped_total")
+        return
+    node = snapshot.prefix(f"/nodes/{NODE_ID}/")
+    global_cfg = snapshot.prefix("/global/")
+    all_nodes = snapshot.prefix("/nodes/")
 
-    def get_all_nodes() -> Dict[str, str]:
-        nonlocal all_nodes_cache
-        if all_nodes_cache is None:
-            all_nodes_cache = load_all_nodes()
-        return all_nodes_cache
+    # Hashes are only recorded (and journaled) once a domain applied successfully.
+    pending: Dict[str, str] = {}
 
     def changed(key: str, val: Any) -> bool:
-        if reconcile_force:
-            return True
         h = sha(val)
-        if last_hash.get(key) != h:
-            last_hash[key] = h
-            return True
-        return False
+        if not reconcile_force and last_hash.get(key) == h:
+            return False
+        pending[key] = h
+        _journal_begin()
+        return True
 
-    did_apply = False
+    def applied(key: str, **record: Any) -> None:
+        _journal_commit(key, pending.pop(key), **record)
 
-    # ========== dnsmasq: START FIRST (priority) ==========
-    # dnsmasq must start before all other services to provide DNS immediately
-    # Additional upstreams (MosDNS/Clash) will be added when they become ready
-    dnsmasq_enabled = node.get(f"/nodes/{NODE_ID}/dnsmasq/enable", "false") == "true"
-    dnsmasq_material = {
-        "enabled": dnsmasq_enabled,
-    }
-    if changed("dnsmasq", dnsmasq_material):
+    # Each domain is a task returning whether it applied anything. Tasks run on
+    # a bounded pool once their dependencies succeeded (see RECONCILE_DEPENDENCIES).
+
+    def task_dnsmasq() -> bool:
+        # dnsmasq must start before all other services to provide DNS immediately
+        # Additional upstreams (MosDNS/Clash) will be added when they become ready
+        dnsmasq_enabled = node.get(f"/nodes/{NODE_ID}/dnsmasq/enable", "false") == "true"
+        dnsmasq_material = {
+            "enabled": dnsmasq_enabled,
+        }
+        if not changed("dnsmasq", dnsmasq_material):
+            return False
         print(f"[dnsmasq] Configuration changed: enabled={dnsmasq_enabled}", flush=True)
         if dnsmasq_enabled:
             # Start dnsmasq with base configuration (fallback DNS only)
@@ -2814,95 +4808,179 @@ def handle_commit() -> None:
             print("[dnsmasq] dnsmasq disabled, stopping...", flush=True)
             _supervisor_stop("dnsmasq")
             print("[dnsmasq] Stopped", flush=True)
-        did_apply = True
-    # ========== dnsmasq: START FIRST (priority) ==========
-
-    healthy_enabled = node.get(f"/nodes/{NODE_ID}/healthy/enable", "false") == "true"
-    healthy_port = _parse_tcp_port(node.get(f"/nodes/{NODE_ID}/healthy/port", ""))
-    healthy_material = {
-        "enabled": healthy_enabled,
-        "port": healthy_port,
-    }
-    if changed("healthy", healthy_material):
+        applied("dnsmasq", programs=["dnsmasq"] if dnsmasq_enabled else [])
+        return True
+
+    def task_healthy() -> bool:
+        healthy_enabled = node.get(f"/nodes/{NODE_ID}/healthy/enable", "false") == "true"
+        healthy_port = _parse_tcp_port(node.get(f"/nodes/{NODE_ID}/healthy/port", ""))
+        healthy_material = {
+            "enabled": healthy_enabled,
+            "port": healthy_port,
+        }
+        if not changed("healthy", healthy_material):
+            return False
         configure_healthy_listener(healthy_enabled, healthy_port)
-        did_apply = True
+        applied("healthy")
+        return True
 
-    portforward_specs = _parse_portforward_specs(node.get(f"/nodes/{NODE_ID}/portforward", ""))
-    if changed("portforward", portforward_specs):
+    def task_portforward() -> bool:
+        portforward_specs = _parse_portforward_specs(node.get(f"/nodes/{NODE_ID}/portforward", ""))
+        if not changed("portforward", {"specs": portforward_specs, "backend": FIREWALL_BACKEND}):
+            return False
         _apply_portforward_rules(portforward_specs)
-        did_apply = True
+        if not portforward_specs:
+            checks: List[List[str]] = []
+        elif FIREWALL_BACKEND == "nftables":
+            checks = [_nft_chain_check("portfw_prerouting"), ["iptables", "-S", PORTFORWARD_FORWARD_CHAIN]]
+        else:
+            checks = [
+                ["iptables", "-t", "nat", "-S", PORTFORWARD_PREROUTING_CHAIN],
+                ["iptables", "-t", "nat", "-S", PORTFORWARD_POSTROUTING_CHAIN],
+                ["iptables", "-S", PORTFORWARD_FORWARD_CHAIN],
+            ]
+        applied("portforward", checks=checks, state={"installed": dict(_portforward_installed)})
+        return True
 
-    mesh_type = global_cfg.get("/global/mesh_type", "easytier")
-    if mesh_type == "tinc":
-        _supervisor_stop("easytier")
-        all_nodes = load_all_nodes()
-        tinc_domain = {k: v for k, v in all_nodes.items() if "/tinc/" in k}
-        global_tinc = {k: v for k, v in global_cfg.items() if k == "/global/mesh_type" or k.startswith("/global/tinc/")}
-        if changed("tinc", {"nodes": tinc_domain, "global": global_tinc}):
-            if node.get(f"/nodes/{NODE_ID}/tinc/enable") == "true":
+    def task_mesh() -> bool:
+        mesh_type = global_cfg.get("/global/mesh_type", "easytier")
+        if mesh_type == "tinc":
+            _supervisor_stop("easytier")
+            _journal_forget("easytier")
+            tinc_domain = {k: v for k, v in all_nodes.items() if "/tinc/" in k}
+            global_tinc = {k: v for k, v in global_cfg.items() if k == "/global/mesh_type" or k.startswith("/global/tinc/")}
+            if not changed("tinc", {"nodes": tinc_domain, "global": global_tinc}):
+                return False
+            tinc_enabled = node.get(f"/nodes/{NODE_ID}/tinc/enable") == "true"
+            if tinc_enabled:
                 reload_tinc(node, all_nodes, global_cfg)
             else:
                 _supervisor_stop("tinc")
-            did_apply = True
-    else:
+            applied("tinc", programs=["tinc"] if tinc_enabled else [])
+            return True
+
         _supervisor_stop("tinc")
+        _journal_forget("tinc")
         easytier_domain = {k: v for k, v in node.items() if "/easytier/" in k}
         global_easy = {k: v for k, v in global_cfg.items() if k.startswith("/global/easytier/")}
-        if changed("easytier", {"node": easytier_domain, "global": global_easy}):
-            if node.get(f"/nodes/{NODE_ID}/easytier/enable") == "true":
-                reload_easytier(node, global_cfg)
-            else:
-                _supervisor_stop("easytier")
-            did_apply = True
+        if not changed("easytier", {"node": easytier_domain, "global": global_easy}):
+            return False
+        easytier_enabled = node.get(f"/nodes/{NODE_ID}/easytier/enable") == "true"
+        if easytier_enabled:
+            reload_easytier(node, global_cfg)
+        else:
+            _supervisor_stop("easytier")
+        applied("easytier", programs=["easytier"] if easytier_enabled else [])
+        return True
 
-    openvpn_domain = {k: v for k, v in node.items() if "/openvpn/" in k}
-    if changed("openvpn", openvpn_domain):
+    def task_openvpn() -> bool:
+        openvpn_domain = {k: v for k, v in node.items() if "/openvpn/" in k}
+        if not changed("openvpn", openvpn_domain):
+            return False
         changed_ovpn, enabled = reload_openvpn(node)
-        did_apply = did_apply or changed_ovpn
+        with _ovpn_lock:
+            ovpn_devs = {name: _ovpn_devs[name] for name in enabled if name in _ovpn_devs}
+        applied("openvpn", programs=[f"openvpn-{name}" for name in enabled], state={"devs": ovpn_devs})
         for name in enabled:
             with _ovpn_lock:
                 dev = _ovpn_devs.get(name) or (f"tun{name[-1]}" if name and name[-1].isdigit() else f"tun-{name}")
             _write_openvpn_status(name, _compute_openvpn_status(name, dev))
+        return changed_ovpn
 
-    access_domain = {k: v for k, v in node.items() if "/access/" in k}
-    global_access = {k: v for k, v in global_cfg.items() if k.startswith("/global/access/")}
-    if changed("access", {"node": access_domain, "global": global_access}):
-        did_apply = reload_access_openvpn(node, global_cfg, get_all_nodes()) or did_apply
+    def task_access() -> bool:
+        access_domain = {k: v for k, v in node.items() if "/access/" in k}
+        global_access = {k: v for k, v in global_cfg.items() if k.startswith("/global/access/")}
+        if not changed("access", {"node": access_domain, "global": global_access}):
+            return False
+        changed_access = reload_access_openvpn(node, global_cfg, all_nodes)
         with _ovpn_lock:
             dev = _ovpn_devs.get("access")
+        applied(
+            "access",
+            programs=["openvpn-access"] if dev else [],
+            state={"devs": {"access": dev}} if dev else {},
+        )
         if dev:
             _write_openvpn_status("access", _compute_openvpn_status("access", dev))
+        return changed_access
 
-    wireguard_domain = {k: v for k, v in node.items() if "/wireguard/" in k}
-    if changed("wireguard", wireguard_domain):
+    def task_wireguard() -> bool:
+        wireguard_domain = {k: v for k, v in node.items() if "/wireguard/" in k}
+        if not changed("wireguard", wireguard_domain):
+            return False
         changed_wg, enabled = reload_wireguard(node)
-        did_apply = did_apply or changed_wg
+        with _wg_lock:
+            wg_devs = {name: _wg_devs[name] for name in enabled if name in _wg_devs}
+        applied("wireguard", programs=[f"wireguard-{name}" for name in enabled], state={"devs": wg_devs})
         for name in enabled:
             with _wg_lock:
                 dev = _wg_devs.get(name) or _wg_dev_name(name)
             _write_wireguard_status(name, _compute_wireguard_status(name, dev))
-
-    # FRR depends on node routing config + global BGP filter policy + network mapping
-    frr_material = {k: v for k, v in node.items() if (
-        "/ospf/" in k or "/bgp/" in k or "/lan/" in k or "/openvpn/" in k or "/wireguard/" in k or "/network_mapping/" in k or "/access/" in k
-    )}
-    global_bgp_related = {k: v for k, v in global_cfg.items() if k.startswith("/global/bgp/") or k.startswith("/global/access/")}
-    if changed("frr", {"node": frr_material, "global": global_bgp_related}):
-        payload = {"node_id": NODE_ID, "node": node, "global": global_cfg, "all_nodes": get_all_nodes()}
+        return changed_wg
+
+    def task_frr() -> bool:
+        # FRR depends on node routing config + global BGP filter policy + network mapping
+        frr_material = {k: v for k, v in node.items() if (
+            "/ospf/" in k or "/bgp/" in k or "/lan/" in k or "/openvpn/" in k or "/wireguard/" in k or "/network_mapping/" in k or "/access/" in k
+        )}
+        global_bgp_related = {k: v for k, v in global_cfg.items() if (
+            k.startswith("/global/bgp/") or k.startswith("/global/access/") or k == "/global/latency_routing"
+        )}
+        # Measured transport costs only feed the render when latency routing is on
+        frr_latency = latency if global_cfg.get("/global/latency_routing") == "true" else {}
+        # A route-reflector client's neighbors are the other nodes' reflectors
+        route_reflectors = sorted(
+            all_nodes.get(k[:-len("/bgp/route_reflector")] + "/router_id", "")
+            for k, v in all_nodes.items()
+            if k.endswith("/bgp/route_reflector") and v == "true"
+        )
+        if not changed("frr", {
+            "node": frr_material, "global": global_bgp_related, "latency": frr_latency, "backend": FIREWALL_BACKEND,
+            "route_reflectors": route_reflectors,
+        }):
+            return False
+        payload = {"node_id": NODE_ID, "node": node, "global": global_cfg, "all_nodes": all_nodes, "latency": frr_latency}
         out = _run_generator("gen_frr", payload)
-        reload_frr_smooth(out["frr_conf"])
+        set_latency_targets(out.get("latency_targets", {}))
+        apply_frr(out["frr_conf"], out.get("frr_model"), full=reconcile_force)
+        frr_status_applied()
         # Apply network mapping NAT rules if any
         network_mappings = out.get("network_mappings", [])
         if network_mappings:
             _apply_network_mapping_nat(network_mappings)
         else:
             _remove_network_mapping_nat()
-        did_apply = True
+        netmap_checks: List[List[str]] = []
+        if FIREWALL_BACKEND == "nftables":
+            if network_mappings:
+                netmap_checks.append(_nft_chain_check("netmap_prerouting"))
+        else:
+            for rule in _render_network_mapping_rules(network_mappings)["nat"]:
+                netmap_checks.append(["iptables", "-t", "nat", "-C"] + rule[len("-A "):].split())
+        applied(
+            "frr",
+            programs=["watchfrr"],
+            checks=netmap_checks,
+            artifacts=["/etc/frr/frr.conf"],
+            state={
+                "frr_model": out.get("frr_model"),
+                "latency_targets": out.get("latency_targets", {}),
+                "latency_costs": latency,
+                "latency_smoothed": latency_smoothed(),
+            },
+        )
+        return True
+
+    def task_clash() -> bool:
+        global tproxy_enabled, _tproxy_check_enabled, _clash_monitoring_enabled
+        global _clash_refresh_enable, _clash_refresh_interval, _clash_refresh_next
 
-    clash_domain = {k: v for k, v in node.items() if "/clash/" in k}
-    global_clash = {k: v for k, v in global_cfg.items() if k.startswith("/global/clash/")}
-    if changed("clash", {"node": clash_domain, "global": global_clash}):
-        if node.get(f"/nodes/{NODE_ID}/clash/enable") != "true":
+        clash_domain = {k: v for k, v in node.items() if "/clash/" in k}
+        global_clash = {k: v for k, v in global_cfg.items() if k.startswith("/global/clash/")}
+        if not changed("clash", {"node": clash_domain, "global": global_clash, "backend": FIREWALL_BACKEND}):
+            return False
+        clash_enabled = node.get(f"/nodes/{NODE_ID}/clash/enable") == "true"
+        if not clash_enabled:
             # Stop clash (mihomo) service
             try:
                 tproxy_remove()
@@ -2917,108 +4995,161 @@ def handle_commit() -> None:
                 _clash_refresh_enable = False
             with _tproxy_check_lock:
                 _tproxy_check_enabled = False
-        else:
-            # Check if clash needs restart (mode change or subscription change)
-            payload = {"node_id": NODE_ID, "node": node, "global": global_cfg, "all_nodes": {}}
-            out = _run_generator("gen_clash", payload)
-            new_mode = out["mode"]
-            api_controller = out.get("api_controller", "")
-            api_secret = out.get("api_secret", "")
-
-            # If switching to/from tproxy mode, need to remove tproxy first
-            if tproxy_enabled and new_mode != "tproxy":
-                try:
-                    tproxy_remove()
-                except Exception:
-                    pass
-                tproxy_enabled = False
-                with _clash_monitoring_lock:
-                    _clash_monitoring_enabled = False
-
-            # Start clash if not running
-            if not _supervisor_is_running("mihomo"):
-                _supervisor_start("mihomo")
-                # Wait a bit for clash to start
-                time.sleep(2)
-
-            # Reload configuration with API credentials
-            reload_clash(out["config_yaml"], api_controller=api_controller, api_secret=api_secret)
+            applied("clash")
+            return True
 
-            # Apply tproxy if needed (MANDATORY wait for Mihomo to be healthy - NO TIMEOUT)
-            if new_mode == "tproxy":
-                print("[clash] Waiting for Mihomo to become healthy before applying TProxy (no timeout - will wait indefinitely)...", flush=True)
-                wait_for_clash_healthy_infinite()
+        # Check if clash needs restart (mode change or subscription change)
+        payload = {"node_id": NODE_ID, "node": node, "global": global_cfg, "all_nodes": {}}
+        out = _run_generator("gen_clash", payload)
+        new_mode = out["mode"]
+        api_controller = out.get("api_controller", "")
+        api_secret = out.get("api_secret", "")
 
-                # Create empty ipset immediately (non-blocking)
-                # IPs will be populated asynchronously after TProxy is applied
-                print("[clash] Initializing proxy IP ipset...", flush=True)
-                _ensure_proxy_ipset()
+        # If switching to/from tproxy mode, need to remove tproxy first
+        if tproxy_enabled and new_mode != "tproxy":
+            try:
+                tproxy_remove()
+            except Exception:
+                pass
+            tproxy_enabled = False
+            with _clash_monitoring_lock:
+                _clash_monitoring_enabled = False
+
+        # Start clash if not running
+        if not _supervisor_is_running("mihomo"):
+            _supervisor_start("mihomo")
+            # Wait a bit for clash to start
+            time.sleep(2)
+
+        # Reload configuration with API credentials
+        reload_clash(out["config_yaml"], api_controller=api_controller, api_secret=api_secret)
+
+        # Apply tproxy if needed (MANDATORY wait for Mihomo to be healthy - NO TIMEOUT)
+        if new_mode == "tproxy":
+            print("[clash] Waiting for Mihomo to become healthy before applying TProxy (no timeout - will wait indefinitely)...", flush=True)
+            wait_for_clash_healthy_infinite()
+
+            # Create empty ipset immediately (non-blocking)
+            # IPs will be populated asynchronously after TProxy is applied
+            print("[clash] Initializing proxy IP ipset...", flush=True)
+            _ensure_proxy_ipset()
+
+            _apply_tproxy_with_verify(
+                out["tproxy_targets"],
+                _clash_exclude_src(node),
+                _clash_exclude_ifaces(node),
+                [],  # No individual IPs, using ipset instead
+                _clash_exclude_ports(node, global_cfg),
+                out.get("tproxy_protocol", "tcp+udp"),
+                out.get("use_conntrack", False),
+                out.get("exclude_rfc1918", False),
+            )
+            _set_cached_tproxy_targets(out["tproxy_targets"])
+            tproxy_enabled = True
+            with _tproxy_check_lock:
+                _tproxy_check_enabled = True
+            with _clash_monitoring_lock:
+                _clash_monitoring_enabled = True
+            print("[clash] TProxy applied successfully", flush=True)
+
+            # Start async IP extraction in background thread
+            # This won't block TProxy startup
+            threading.Thread(target=_update_proxy_ips_async, daemon=True).start()
+        else:
+            # Not in TProxy mode, cleanup proxy IP ipset
+            _cleanup_proxy_ips()
 
-                _apply_tproxy_with_verify(
-                    out["tproxy_targets"],
-                    _clash_exclude_src(node),
-                    _clash_exclude_ifaces(node),
-                    [],  # No individual IPs, using ipset instead
-                    _clash_exclude_ports(node, global_cfg),
-                    out.get("tproxy_protocol", "tcp+udp"),
-                    out.get("use_conntrack", False),
-                    out.get("exclude_rfc1918", False),
-                )
-                _set_cached_tproxy_targets(out["tproxy_targets"])
-                tproxy_enabled = True
-                with _tproxy_check_lock:
-                    _tproxy_check_enabled = True
-                with _clash_monitoring_lock:
-                    _clash_monitoring_enabled = True
-                print("[clash] TProxy applied successfully", flush=True)
-
-                # Start async IP extraction in background thread
-                # This won't block TProxy startup
-                threading.Thread(target=_update_proxy_ips_async, daemon=True).start()
-            else:
-                # Not in TProxy mode, cleanup proxy IP ipset
-                _cleanup_proxy_ips()
+            with _tproxy_check_lock:
+                _tproxy_check_enabled = False
+            with _clash_monitoring_lock:
+                _clash_monitoring_enabled = False
 
-                with _tproxy_check_lock:
-                    _tproxy_check_enabled = False
-                with _clash_monitoring_lock:
-                    _clash_monitoring_enabled = False
+        # Update dnsmasq upstream to include Clash DNS (if dnsmasq is enabled)
+        dnsmasq_enabled = node.get(f"/nodes/{NODE_ID}/dnsmasq/enable", "false") == "true"
+        if dnsmasq_enabled:
+            mosdns_enabled = node.get(f"/nodes/{NODE_ID}/mosdns/enable") == "true"
+            print("[clash] Updating dnsmasq upstream to include Clash DNS", flush=True)
+            _update_dnsmasq_upstreams(add_mosdns=mosdns_enabled, add_clash=True)
 
-            # Update dnsmasq upstream to include Clash DNS (if dnsmasq is enabled)
-            dnsmasq_enabled = node.get(f"/nodes/{NODE_ID}/dnsmasq/enable", "false") == "true"
-            if dnsmasq_enabled:
-                mosdns_enabled = node.get(f"/nodes/{NODE_ID}/mosdns/enable") == "true"
-                print("[clash] Updating dnsmasq upstream to include Clash DNS", flush=True)
-                _update_dnsmasq_upstreams(add_mosdns=mosdns_enabled, add_clash=True)
+        with _clash_refresh_lock:
+            _clash_refresh_enable = out["refresh_enable"]
+            _clash_refresh_interval = max(0, int(out["refresh_interval_minutes"]))
+            _clash_refresh_next = time.time() + (_clash_refresh_interval * 60)
+        applied(
+            "clash",
+            programs=["mihomo"],
+            checks=[
+                _nft_chain_check("tproxy_prerouting") if FIREWALL_BACKEND == "nftables"
+                else ["iptables", "-t", "mangle", "-S", "CLASH_TPROXY"]
+            ] if tproxy_enabled else [],
+            artifacts=["/etc/clash/config.yaml"],
+            state={
+                "enabled": True,
+                "api_secret": CLASH_API_SECRET,
+                "refresh_enable": _clash_refresh_enable,
+                "refresh_interval": _clash_refresh_interval,
+                "tproxy": tproxy_enabled,
+                "tproxy_targets": _get_cached_tproxy_targets(),
+                "tproxy_installed": dict(_tproxy_installed),
+            },
+        )
+        return True
 
-            with _clash_refresh_lock:
-                _clash_refresh_enable = out["refresh_enable"]
-                _clash_refresh_interval = max(0, int(out["refresh_interval_minutes"]))
-                _clash_refresh_next = time.time() + (_clash_refresh_interval * 60)
-        did_apply = True
-
-    mosdns_enabled = node.get(f"/nodes/{NODE_ID}/mosdns/enable") == "true"
-    mosdns_material = {
-        "enabled": mosdns_enabled,
-        "refresh": node.get(f"/nodes/{NODE_ID}/mosdns/refresh", ""),
-        "global": {k: v for k, v in global_cfg.items() if k.startswith("/global/mosdns/")},
-    }
-    if changed("mosdns", mosdns_material):
+    def task_mosdns() -> bool:
+        mosdns_enabled = node.get(f"/nodes/{NODE_ID}/mosdns/enable") == "true"
+        mosdns_material = {
+            "enabled": mosdns_enabled,
+            "refresh": node.get(f"/nodes/{NODE_ID}/mosdns/refresh", ""),
+            "global": {k: v for k, v in global_cfg.items() if k.startswith("/global/mosdns/")},
+        }
+        if not changed("mosdns", mosdns_material):
+            return False
         if mosdns_enabled:
             reload_mosdns(node, global_cfg)
         else:
             _supervisor_stop("mosdns")
             # Note: Don't stop dnsmasq here, it's controlled independently
-        did_apply = True
+        applied(
+            "mosdns",
+            programs=["mosdns"] if mosdns_enabled else [],
+            artifacts=["/etc/mosdns/config.yaml"] if mosdns_enabled else [],
+        )
+        return True
+
+    tasks = {
+        "dnsmasq": task_dnsmasq,
+        "healthy": task_healthy,
+        "portforward": task_portforward,
+        "mesh": task_mesh,
+        "openvpn": task_openvpn,
+        "access": task_access,
+        "wireguard": task_wireguard,
+        "frr": task_frr,
+        "clash": task_clash,
+        "mosdns": task_mosdns,
+    }
+    durations: Dict[str, float] = {}
+    results, first_error = _run_reconcile_tasks(tasks, RECONCILE_DEPENDENCIES, RECONCILE_WORKERS, durations)
+    slowest = sorted(durations.items(), key=lambda kv: kv[1], reverse=True)[:3]
+    print(
+        f"[reconcile] domains done: applied={sorted(k for k, v in results.items() if v) or '-'} "
+        f"slowest={', '.join(f'{k}={v:.2f}s' for k, v in slowest)}",
+        flush=True,
+    )
+    if first_error is not None:
+        raise first_error
+    did_apply = any(results.values())
 
     # etcd_hosts: process on every /commit (not watched separately)
     # This ensures etcd_hosts is always synchronized with etcd state
     try:
-        update_etcd_hosts()
+        update_etcd_hosts(snapshot.prefix(f"{ETCD_HOSTS_PREFIX}/"))
     except Exception as e:
         print(f"[reconcile] etcd_hosts update failed: {e}", flush=True)
 
     reconcile_force = False
+    _last_snapshot_fingerprint = snapshot.fingerprint
+    _last_latency_costs = latency
 
     if did_apply:
         publish_update("config-applied")
@@ -3027,35 +5158,82 @@ def handle_commit() -> None:
 def reconcile_once() -> None:
     if not _reconcile_lock.acquire(blocking=False):
         return
+    start = time.monotonic()
+    result = "error"
     try:
         handle_commit()
+        result = "ok"
     finally:
         _reconcile_lock.release()
+        metrics.inc("meduza_reconcile_total", result=result)
+        metrics.observe("meduza_reconcile_duration_seconds", time.monotonic() - start)
+        metrics.set("meduza_reconcile_last_timestamp_seconds", time.time())
+
+
+def request_reconcile(reason: str, revision: int = 0) -> None:
+    """Ask the reconcile worker for a pass; requests made while one is running coalesce."""
+    global _reconcile_generation, _commit_revision
+    with _reconcile_cond:
+        _reconcile_generation += 1
+        _commit_revision = max(_commit_revision, revision)
+        _reconcile_reasons[reason] = _reconcile_reasons.get(reason, 0) + 1
+        _reconcile_cond.notify_all()
+
+
+def reconcile_worker_loop() -> None:
+    """Single consumer of reconcile requests.
+
+    Each pass reconciles the newest generation. If more requests arrived
+    while it ran, exactly one more pass follows, whatever their number.
+    """
+    seen = 0
+    while True:
+        with _reconcile_cond:
+            _reconcile_cond.wait_for(lambda: _reconcile_generation != seen)
+            target = _reconcile_generation
+            reasons = dict(_reconcile_reasons)
+            _reconcile_reasons.clear()
+        if target - seen > 1:
+            print(f"[reconcile] coalesced {target - seen} request(s): {reasons}", flush=True)
+        seen = target
+        try:
+            reconcile_once()
+        except Exception as e:
+            print(f"[reconcile] error: {e}", flush=True)
 
 
 # ---------- watch loop ----------
 
 def watch_loop() -> None:
+    """Watch /commit without gaps.
+
+    The first watch starts right after the revision the startup reconcile is
+    requested at; reconnects resume from the last seen revision + 1. If that
+    revision has been compacted, a full reconcile is requested and the watch
+    restarts from the current head.
+    """
     backoff = Backoff()
+    last_rev = 0
     while True:
         cancel = None
         try:
-            try:
-                reconcile_once()
-            except Exception as e:
-                print(f"[reconcile] error: {e}", flush=True)
+            if last_rev == 0:
+                last_rev = _etcd_call(lambda: etcd.get_response("/commit")).header.revision
+                request_reconcile("resync", last_rev)
 
+            start = last_rev + 1
+            events, cancel = _etcd_call(lambda: etcd.watch("/commit", start_revision=start))
             backoff.reset()
-            events, cancel = _etcd_call(lambda: etcd.watch("/commit"))
-            for _ in events:
-                try:
-                    reconcile_once()
-                except Exception as e:
-                    print(f"[reconcile] error: {e}", flush=True)
+            for ev in events:
+                last_rev = max(last_rev, ev.mod_revision)
+                request_reconcile("commit", ev.mod_revision)
 
+        except etcd3.exceptions.RevisionCompactedError as e:
+            print(f"[watch] resume revision {last_rev + 1} compacted ({e}); full resync", flush=True)
+            last_rev = 0
         except Exception as e:
             t = backoff.next_sleep()
-            print(f"[watch] error: {e}; retry in {t:.1f}s", flush=True)
+            print(f"[watch] error: {e}; resume from rev={last_rev + 1} in {t:.1f}s", flush=True)
             time.sleep(t)
         finally:
             try:
@@ -3068,18 +5246,19 @@ def watch_loop() -> None:
 def periodic_reconcile_loop() -> None:
     while True:
         time.sleep(300)
-        try:
-            reconcile_once()
-        except Exception as e:
-            print(f"[reconcile] periodic error: {e}", flush=True)
+        request_reconcile("periodic")
 
 
 # ---------- etcd_hosts ----------
-def _load_dns_hosts() -> Dict[str, List[str]]:
-    """Load all DNS host records from etcd. Supports multiple IPs per hostname (one per line)."""
+def _load_dns_hosts(records: Optional[Dict[str, str]] = None) -> Dict[str, List[str]]:
+    """Load all DNS host records from etcd. Supports multiple IPs per hostname (one per line).
+
+    When ``records`` is given (e.g. the reconcile snapshot), it is used instead of a fresh read.
+    """
     hosts: Dict[str, List[str]] = {}
     try:
-        records = load_prefix(ETCD_HOSTS_PREFIX + "/")
+        if records is None:
+            records = load_prefix(ETCD_HOSTS_PREFIX + "/")
         for key, value in records.items():
             # Key format: /dns/hosts/example.com => "192.168.1.1\n192.168.1.2"
             # Extract hostname from key
@@ -3137,11 +5316,11 @@ def _reload_dnsmasq_hosts_if_running() -> None:
 _etcd_hosts_hash: str = ""
 
 
-def update_etcd_hosts() -> None:
+def update_etcd_hosts(records: Optional[Dict[str, str]] = None) -> None:
     """Update etcd_hosts file from etcd records."""
     global _etcd_hosts_hash
     try:
-        hosts = _load_dns_hosts()
+        hosts = _load_dns_hosts(records)
         current_hash = sha(hosts)
 
         if current_hash != _etcd_hosts_hash:
@@ -3165,17 +5344,32 @@ def main() -> None:
     except Exception as e:
         print(f"[init] failed to create {ETCD_HOSTS_PATH}: {e}", flush=True)
 
+    if ETCD_MIRROR_ENABLE:
+        threading.Thread(target=etcd_mirror.run, daemon=True).start()
+    if FIREWALL_BACKEND != "nftables":
+        _nft_remove_table()
+    migrate_legacy_network_mapping()
+    load_reconcile_journal()
+    load_generator_cache()
+
     threading.Thread(target=keepalive_loop, daemon=True).start()
     threading.Thread(target=openvpn_status_loop, daemon=True).start()
     threading.Thread(target=wireguard_status_loop, daemon=True).start()
+    if LATENCY_PROBE_INTERVAL > 0:
+        threading.Thread(target=latency_probe_loop, daemon=True).start()
+    if FRR_STATUS_INTERVAL > 0:
+        threading.Thread(target=frr_status_loop, daemon=True).start()
     threading.Thread(target=monitor_children_loop, daemon=True).start()
     threading.Thread(target=supervisor_retry_loop, daemon=True).start()
     threading.Thread(target=clash_refresh_loop, daemon=True).start()
     threading.Thread(target=clash_crash_monitor_loop, daemon=True).start()
     threading.Thread(target=healthy_port_loop, daemon=True).start()
+    if METRICS_LISTEN:
+        threading.Thread(target=metrics_http_loop, daemon=True).start()
     threading.Thread(target=clash_proxy_ips_monitor_loop, daemon=True).start()
     threading.Thread(target=tproxy_check_loop, daemon=True).start()
     threading.Thread(target=periodic_reconcile_loop, daemon=True).start()
+    threading.Thread(target=reconcile_worker_loop, daemon=True).start()
     # etcd_hosts now processed in reconcile_once() via /commit, no separate watch needed
 
     publish_update("startup")